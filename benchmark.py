@@ -0,0 +1,348 @@
+"""
+This module benchmarks the solver on generated problems, and compares the
+results with a stored baseline.
+
+Run it as a script:
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+
+Each case is solved with the same model and search every time, so its node
+and propagation counts are reproducible; a change in them means the search
+itself changed. Times and memory are compared within a tolerance.
+
+The quick suite's results are kept in BASELINE, next to this module. Like
+the examples the word square and cryptarithm cases are built from, it only
+exists in a source checkout; setup.py installs this module but not them.
+The tests check the counts against it; update it with
+
+    python benchmark.py --output benchmark-baseline.json
+
+when a change to the search is meant to change them.
+"""
+
+from csp import *
+
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-baseline.json')
+
+CRYPTARITHMS = [
+    "send + more = money",
+    "cross + roads = danger",
+    "use + less = kiddy",
+    "green + orange = colors",
+    "taurus + pisces = scorpio",
+    "one + two + two + three + three = eleven",
+]
+
+# Too slow to count under tracemalloc for the quick suite.
+LONG_CRYPTARITHMS = [
+    "so + many + more + men + seem + to + say + that + they + may + soon + try + to"
+    " + stay + at + home + so + as + to + see + or + hear + the + same + one + man"
+    " + try + to + meet + the + team + on + the + moon + as + he + has + at + the"
+    " + other + ten = tests",
+]
+
+
+class QueensConstraint(BaseConstraint):
+    """
+    A constraint that two queens in different columns, `distance` columns
+    apart, don't attack each other. The variables' values are the queens'
+    rows.
+    """
+    def __init__(self, variables, distance):
+        BaseConstraint.__init__(self, variables)
+        self.distance = distance
+
+    def is_satisfiable(self, variable, assignment):
+        return self.find_support(variable, assignment) is not None
+
+    def find_support(self, variable, assignment):
+        (a, b) = self.variables
+        other = b if variable is a else a
+        for value in other.domain:
+            if value != assignment and abs(value - assignment) != self.distance:
+                return (assignment, value) if variable is a else (value, assignment)
+        return None
+
+
+def queens(n):
+    """
+    Build the n-queens problem: one variable per column, whose value is the
+    row of the column's queen.
+    """
+    problem = ConstraintSatisfactionProblem()
+    for i in range(n):
+        problem.variables[i] = BaseVariable(problem, i)
+        problem.variables[i].domain = range(n)
+    for (i, j) in itertools.combinations(range(n), 2):
+        problem.constraints.add(QueensConstraint([problem.variables[i], problem.variables[j]], j - i))
+    return problem
+
+
+def graph_coloring(n, m, k, seed=0):
+    """
+    Build a random graph coloring problem from Model B: a graph with n
+    vertices and m distinct edges drawn uniformly at random, to be colored
+    with k colors.
+    """
+    rng = random.Random(seed)
+    problem = ConstraintSatisfactionProblem()
+    problem.is_disjoint_constraints = True
+    for i in range(n):
+        problem.variables[i] = BaseVariable(problem, i)
+        problem.variables[i].domain = range(k)
+    for (i, j) in rng.sample(list(itertools.combinations(range(n), 2)), m):
+        problem.constraints.add(AllDifferentConstraint([problem.variables[i], problem.variables[j]]))
+    return problem
+
+
+def latin_square(n, filled=0.0, seed=0):
+    """
+    Build a Latin square problem of order n: fill an n x n grid with n
+    symbols so that no symbol repeats in a row or column.
+
+    Args:
+        n (int): The order of the square
+        filled (float): The fraction of cells given in advance, copied from
+            a random Latin square, which makes it a quasigroup completion
+            problem
+        seed: Seeds the random square and the choice of given cells
+    """
+    rng = random.Random(seed)
+    rows = list(range(n))
+    columns = list(range(n))
+    symbols = list(range(n))
+    for order in (rows, columns, symbols):
+        rng.shuffle(order)
+
+    problem = ConstraintSatisfactionProblem()
+    for (r, c) in itertools.product(range(n), repeat=2):
+        var = problem.variables[(r, c)] = BaseVariable(problem, (r, c))
+        var.domain = range(n)
+        if rng.random() < filled:
+            var.domain = [symbols[(rows[r] + columns[c]) % n]]
+    for i in range(n):
+        problem.constraints.add(AllDifferentConstraint(problem.variables[(i, c)] for c in range(n)))
+        problem.constraints.add(AllDifferentConstraint(problem.variables[(r, i)] for r in range(n)))
+    return problem
+
+
+def _example(name):
+    """
+    Import an example module, or return None if the examples aren't there.
+    """
+    if not os.path.isdir(EXAMPLES):
+        return None
+    if EXAMPLES not in sys.path:
+        sys.path.append(EXAMPLES)
+    return __import__(name)
+
+
+_wordsquares = dict()
+
+
+def word_square(size):
+    """
+    Build the word square problem of the given size from the examples'
+    dictionary.
+    """
+    path = os.path.join(EXAMPLES, 'resources', 'words.txt')
+    if path not in _wordsquares:
+        _wordsquares[path] = _example('wordsquare').WordSquare(path)
+    return _wordsquares[path].csp(size, False)
+
+
+def cryptarithm(puzzle):
+    """
+    Build a cryptarithmetic problem with the example's model.
+    """
+    return _example('cryptarithmetic').Cryptarithmetic(puzzle)
+
+
+def cases(suite='quick'):
+    """
+    Get the benchmark cases of a suite.
+
+    Args:
+        suite (str): 'quick' for cases that run in seconds altogether, or
+            'full' to add larger queens, Latin squares, word squares and
+            cryptarithms
+
+    Returns:
+        A list of (name, factory, mode) tuples, where factory() builds the
+        problem and mode is 'solve' to find one solution or 'count' to find
+        them all.
+    """
+    result = [
+        ('queens-8-all', lambda: queens(8), 'count'),
+        ('queens-30', lambda: queens(30), 'solve'),
+        ('coloring-b-60-130-4', lambda: graph_coloring(60, 130, 4, seed=1), 'solve'),
+        ('coloring-b-30-70-3-all', lambda: graph_coloring(30, 70, 3, seed=2), 'count'),
+        ('latin-8', lambda: latin_square(8), 'solve'),
+        ('latin-12-qcp', lambda: latin_square(12, filled=0.4, seed=3), 'solve'),
+    ]
+    if suite == 'full':
+        result += [
+            ('queens-10-all', lambda: queens(10), 'count'),
+            ('latin-20', lambda: latin_square(20), 'solve'),
+        ]
+    if _example('wordsquare') is not None:
+        for size in range(3, 8 if suite == 'full' else 6):
+            result.append(('wordsquare-{}'.format(size), lambda size=size: word_square(size), 'solve'))
+        for puzzle in CRYPTARITHMS + (LONG_CRYPTARITHMS if suite == 'full' else []):
+            name = 'crypt-' + puzzle.split('=')[-1].strip()
+            result.append((name, lambda puzzle=puzzle: cryptarithm(puzzle), 'count'))
+    return result
+
+
+def solve_case(factory, mode):
+    """
+    Build and search one benchmark case once.
+
+    Returns:
+        A dict with the number of solutions found, the search's nodes and
+        propagations (revisions of a constraint), and the wall time in
+        seconds, including building the problem.
+    """
+    start = time.perf_counter()
+    problem = factory()
+    if mode == 'count':
+        solutions = problem.count_solutions()
+    else:
+        solutions = 1 if problem.solve() else 0
+    elapsed = time.perf_counter() - start
+    stats = problem.stats
+    return {'solutions': solutions,
+            'nodes': stats.nodes,
+            'propagations': sum(stats.revisions.values()),
+            'time': elapsed}
+
+
+def run_case(factory, mode, repeat=1):
+    """
+    Run one benchmark case.
+
+    The problem is built and searched `repeat` times for the best time, and
+    once more under tracemalloc for its peak memory, so that tracing doesn't
+    slow the timed runs.
+
+    Returns:
+        A dict with the number of solutions found, the search's nodes and
+        propagations (revisions of a constraint), the best wall time in
+        seconds, and the peak memory allocated in bytes. Times include
+        building the problem.
+    """
+    result = min((solve_case(factory, mode) for _ in range(repeat)), key=lambda r: r['time'])
+
+    tracemalloc.start()
+    try:
+        solve_case(factory, mode)
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def run(suite='quick', repeat=1, select=None, out=None):
+    """
+    Run a benchmark suite.
+
+    Args:
+        suite (str): The suite, as for `cases`
+        repeat (int): The number of timed runs of each case
+        select (str): Only run the cases whose names contain this
+        out: A text file to report progress to, or None
+
+    Returns:
+        A dict with the environment and a map: case name -> result from
+        `run_case`.
+    """
+    results = dict()
+    for (name, factory, mode) in cases(suite):
+        if select and select not in name:
+            continue
+        results[name] = run_case(factory, mode, repeat)
+        if out is not None:
+            r = results[name]
+            out.write('{:<28} {:>9} nodes {:>10} props {:>9.3f}s {:>9.1f}kB\n'.format(
+                name, r['nodes'], r['propagations'], r['time'], r['peak_memory'] / 1024))
+            out.flush()
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'suite': suite,
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.25, min_time=0.01):
+    """
+    Compare benchmark results with a baseline.
+
+    Node, propagation and solution counts must match exactly, since the
+    search is deterministic. Time and peak memory may grow by a fraction
+    `tolerance` of the baseline's, and time by at least min_time seconds,
+    since the shortest cases are mostly timer noise.
+
+    Args:
+        results (dict): As returned by `run`
+        baseline (dict): An earlier result of `run`
+        tolerance (float): The allowed relative growth in time and memory
+        min_time (float): The time growth in seconds that's always allowed
+
+    Returns:
+        A list of messages describing the regressions, empty if there are
+        none. Cases missing from either side are ignored.
+    """
+    regressions = list()
+    base = baseline['results']
+    for (name, result) in results['results'].items():
+        if name not in base:
+            continue
+        old = base[name]
+        for key in ('solutions', 'nodes', 'propagations'):
+            if result[key] != old[key]:
+                regressions.append('{}: {} changed from {} to {}'.format(name, key, old[key], result[key]))
+        for (key, slack) in (('time', min_time), ('peak_memory', 0)):
+            if old[key] and result[key] > max(old[key] * (1 + tolerance), old[key] + slack):
+                regressions.append('{}: {} grew {:.0%}, from {:.4g} to {:.4g}'.format(
+                    name, key, result[key] / old[key] - 1, old[key], result[key]))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the constraint solver.")
+    parser.add_argument("--suite", choices=['quick', 'full'], default='quick')
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each case; the best counts")
+    parser.add_argument("-k", dest="select", help="Only run the cases whose names contain this")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative growth in time and memory (default 0.25)")
+    args = parser.parse_args(argv)
+
+    results = run(args.suite, args.repeat, args.select, sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print("REGRESSION " + message)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,24 @@
 This module is a framework for solving constraint satisfaction problems.
 """
 
-from collections import deque
+import array
+import asyncio
+import bisect
+from collections import deque, OrderedDict
+from collections.abc import Mapping, Sequence
+import functools
+import heapq
+import io
+import itertools
+import mmap
+import multiprocessing
+import pickle
+import queue
+import random
+import struct
+import threading
+import time
+import traceback
 
 
 class ConstraintSatisfactionProblem:
@@ -14,7 +31,22 @@ class ConstraintSatisfactionProblem:
         constraints (set): The set of the problem's constraints
         is_disjoint_constraints: If the csp is such that any two variables
             uniquely identify a constraint, set this to True for optimizations
+        arc_index (dict): A mapping of variable V -> neighbor N -> list of
+            constraints covering both V and N, built by `freeze`
+        propagation (str): The arc consistency algorithm used by the current
+            solve, one of `PROPAGATION_MODES`
+        stats (SolverStats): The statistics of the last search run by
+            `solve`, `iter_solutions` or `count_solutions`, or None
+        status (str): The outcome of the last solve: 'solved',
+            'unsatisfiable', or 'unknown' if it ran out of time or nodes or
+            was cancelled first; None before the first solve
+        support_cache (SupportCache): If set, the 'ac3' propagation
+            remembers which values each constraint found unsupported, for
+            each state of the other variables' domains; None by default
     """
+
+    PROPAGATION_MODES = ('ac3', 'ac3rm')
+
     def __init__(self):
         """
         Basic constructor.
@@ -24,76 +56,738 @@ class ConstraintSatisfactionProblem:
         self.variables = dict()
         self.constraints = set()
         self.is_disjoint_constraints = False
+        self.arc_index = None
+        self._frozen_constraints = None
+        self._frozen_variables = None
+        self.propagation = 'ac3'
+        self._residues = dict()
+        self._trail = list()
+        self._order = None
+        self._culprits = None
+        self._wipeout = None
+        self._constraint_order = None
+        self._arcs = dict()
+        self.status = None
+        self.stats = None
+        self.support_cache = None
+        self._stats = None
+        self._search = None
+        self._root_consistent = False
+        self._root_wipeout = None
+        self._universes = dict()
+        self._assumptions = list()
+        self._nogoods = list()
+
+    def freeze(self):
+        """
+        Build the static structures the solver uses during propagation.
+
+        Call this once the problem's variables and constraints are in place.
+        `solve` freezes the problem itself if it hasn't been frozen yet, or
+        if variables or constraints were added to or removed from
+        `self.variables` or `self.constraints` since.
+
+        Neighbors are ordered like `self.variables`, and constraints in the
+        order they were created, so that propagation visits them in the same
+        order on every run.
+
+        Returns:
+            self
+        """
+        self._order = {variable: i for (i, variable) in enumerate(self.variables.values())}
+        order = self._order.get
+        by_id = BaseConstraint.get_id
+
+        self.arc_index = dict()
+        for variable in self.variables.values():
+            self.arc_index[variable] = {
+                neighbor: (variable.find_constraint_between(neighbor)
+                           if self.is_disjoint_constraints
+                           else sorted(variable.find_constraints_between(neighbor), key=by_id))
+                for neighbor in sorted(variable.neighbors, key=order)}
+        self._constraint_order = {variable: sorted(variable.constraints, key=by_id)
+                                  for variable in self.variables.values()}
+        self._constraint_order[None] = sorted(self.constraints, key=by_id)
+        self._frozen_constraints = set(self.constraints)
+        self._frozen_variables = list(self.variables.values())
+        self._arcs = dict()
+        self._culprits = {variable: _Mask() for variable in self.variables.values()}
+        self._root_consistent = False
+        return self
+
+    def _ensure_frozen(self):
+        """
+        Freeze the problem if it hasn't been frozen, or if its variables or
+        constraints changed since it was.
+        """
+        if (self.arc_index is None or self.constraints != self._frozen_constraints
+                or self._frozen_variables != list(self.variables.values())):
+            self.freeze()
+
+    def compile(self):
+        """
+        Compile the problem to integer arrays, which can be saved to a file
+        and loaded quickly, in this or another process.
+
+        Returns:
+            A CompiledProblem.
+        """
+        if self._assumptions:
+            raise ValueError("Retract the assumptions before compiling")
+        return CompiledProblem.from_csp(self)
+
+    def _reindex(self, variables):
+        """
+        Rebuild the parts of the frozen structures that concern the given
+        variables, after constraints over them were added or removed.
+        """
+        order = self._order.get
+        by_id = BaseConstraint.get_id
+        for variable in variables:
+            variable._neighbors = None
+        for variable in variables:
+            self.arc_index[variable] = {
+                neighbor: sorted(variable.find_constraints_between(neighbor), key=by_id)
+                for neighbor in sorted(variable.neighbors, key=order)}
+            self._constraint_order[variable] = sorted(variable.constraints, key=by_id)
+            self._arcs.pop(variable, None)
+        self._constraint_order[None] = sorted(self.constraints, key=by_id)
+        self._frozen_constraints = set(self.constraints)
+
+    def _propagate_root(self):
+        """
+        Make the problem arc consistent before any decision, unless it
+        already is.
+
+        Without assumptions, the removals are permanent. The result is kept
+        until a variable's domain is replaced or the problem is frozen
+        again, along with the nogoods learned from it; changes made to
+        domains in place aren't noticed. A wipeout is kept too, so later
+        searches fail at once instead of propagating over empty domains.
+
+        Returns:
+            False if a domain was wiped out, else True.
+        """
+        self._ensure_frozen()
+        if self._root_consistent:
+            if self._root_wipeout is not None:
+                self._wipeout = self._root_wipeout
+                return False
+            return True
+
+        self._nogoods = list()
+        if self.support_cache is not None:
+            self.support_cache.clear()
+        self._ac3()
+        if not self._assumptions:
+            del self._trail[:]
+            self._root_consistent = True
+            self._root_wipeout = self._wipeout
+        return self._wipeout is None
+
+    def _close_search(self):
+        """
+        Undo the decisions of the last search run on the problem.
+        """
+        if self._search is not None:
+            self._search.close()
+            self._search = None
+
+    def assume(self, values=None, removed=None, constraints=()):
+        """
+        Restrict the problem under assumptions that can be retracted later.
+
+        The assumptions are propagated from the problem's arc consistent
+        root state, which is computed once and reused, so solving under new
+        assumptions doesn't repeat the initial propagation. Assumptions
+        stack: each call adds to the ones already in place, and `retract`
+        removes the last ones added. Nogoods learned by restarting searches
+        are kept for as long as the assumptions they were learned under.
+
+        The result can be used as a context manager that retracts the
+        assumptions on exit.
+
+        Args:
+            values (dict): A mapping of variable name -> the only value the
+                variable may take
+            removed (dict): A mapping of variable name -> an iterable of
+                values the variable may not take
+            constraints: An iterable of extra constraints over the problem's
+                variables
+
+        Returns:
+            An Assumption, whose `consistent` is False if propagating the
+            assumptions wiped out a domain.
+        """
+        self._close_search()
+        constraints = list(constraints)
+        scope = {var for c in constraints for var in c.variables}
+
+        # The constraints registered with their variables when they were
+        # made, but they mustn't take part in the root propagation.
+        for c in constraints:
+            for var in c.variables:
+                var.constraints.discard(c)
+        if self.arc_index is not None:
+            self._reindex(scope)
+        consistent = self._propagate_root()
+
+        assumption = Assumption(self, len(self._trail), constraints)
+        self._assumptions.append(assumption)
+        if constraints:
+            for c in constraints:
+                for var in c.variables:
+                    var.constraints.add(c)
+            self.constraints.update(constraints)
+            self._reindex(scope)
+
+        changed = [var for c in assumption.constraints for var in c.variables]
+        restrictions = [(name, [value]) for (name, value) in (values or dict()).items()]
+        for (name, keep) in restrictions:
+            domain = self.variables[name].domain
+            self._set_bits(domain, domain.bits & domain.mask(v for v in keep if v in domain.index))
+            changed.append(self.variables[name])
+        for (name, drop) in (removed or dict()).items():
+            domain = self.variables[name].domain
+            self._set_bits(domain, domain.bits & ~domain.mask(v for v in drop if v in domain.index))
+            changed.append(self.variables[name])
+
+        for var in dict.fromkeys(changed):
+            if not consistent:
+                break
+            if var.domain:
+                self._ac3(var)
+            consistent = bool(var.domain) and self._wipeout is None
+        assumption.consistent = consistent
+        return assumption
+
+    def retract(self):
+        """
+        Retract the assumptions added by the last call to `assume`, with
+        everything propagated or learned from them.
+        """
+        self._close_search()
+        assumption = self._assumptions.pop()
+        self._undo(assumption.mark)
+        if assumption.constraints:
+            for c in assumption.constraints:
+                self.constraints.discard(c)
+                for var in c.variables:
+                    var.constraints.discard(c)
+            self._reindex({var for c in assumption.constraints for var in c.variables})
+        depth = len(self._assumptions)
+        self._nogoods = [(d, nogood) for (d, nogood) in self._nogoods if d <= depth]
+
+    def add_symmetry(self, permutation, key=None):
+        """
+        Declare a symmetry of the problem: a permutation of its variables
+        that maps every solution to another solution.
+
+        The symmetry is broken by a lex-leader constraint. Reading the
+        variables in the order of `self.variables`, a solution is kept only
+        if its values are lexicographically at most those of its image, so
+        at least one solution of every pair is kept. Every symmetry added
+        this way, and every value symmetry added with `add_value_symmetry`
+        whose values are listed in increasing order, is broken with the same
+        orders, so they can be combined.
+
+        Args:
+            permutation (dict): A mapping of variable name -> the name of the
+                variable it's mapped to; variables left out are fixed
+            key: A function of a value to compare it by, or None to compare
+                the values themselves
+
+        Returns:
+            The LexLeqConstraint added, or None if the permutation moves no
+            variable.
+        """
+        pairs = list()
+        seen = set()
+        for (name, var) in self.variables.items():
+            image = permutation.get(name, name)
+            # A pair is equal whenever its mirror image, earlier on, is.
+            if image == name or (image, name) in seen:
+                continue
+            seen.add((name, image))
+            pairs.append((var, self.variables[image]))
+        if not pairs:
+            return None
+        return self._add_symmetry_constraint(
+            LexLeqConstraint([x for (x, _) in pairs], [y for (_, y) in pairs], key))
+
+    def add_value_symmetry(self, values, variables=None):
+        """
+        Declare that some values are interchangeable: swapping any two of
+        them in a solution, in every variable at once, gives another
+        solution, as with the colors of a graph coloring.
+
+        The symmetry is broken by a ValuePrecedenceConstraint: the values
+        must be first used in the order given, reading the variables in the
+        order of `self.variables`. Of the up to n! solutions that differ
+        only by a permutation of n values, one is kept.
+
+        Args:
+            values: An iterable of the interchangeable values
+            variables: An iterable of the names of the variables they're
+                interchangeable in, by default all of them
 
-    def solve(self):
+        Returns:
+            The ValuePrecedenceConstraint added.
+        """
+        if variables is None:
+            scope = list(self.variables.values())
+        else:
+            names = set(variables)
+            scope = [var for (name, var) in self.variables.items() if name in names]
+        return self._add_symmetry_constraint(ValuePrecedenceConstraint(scope, values))
+
+    def _add_symmetry_constraint(self, constraint):
+        """
+        Add a constraint that breaks a symmetry, and bring the frozen
+        structures up to date.
+        """
+        self._close_search()
+        self.constraints.add(constraint)
+        # The new constraint shares pairs of variables with the others.
+        self.is_disjoint_constraints = False
+        if self.arc_index is not None:
+            self._reindex(constraint.variables)
+        self._root_consistent = False
+        return constraint
+
+    def solve(self, propagation='ac3', heuristic='mrv', restarts=None, seed=None,
+              workers=None, tracer=None, profile=False, timeout=None, node_limit=None,
+              cancel=None, decompose=False, value_order='domain'):
         """
         Solves the constraint satisfaction problem.
 
+        Args:
+            propagation (str): 'ac3' re-checks every value from scratch on
+                each revision. 'ac3rm' remembers the last supporting tuple found
+                for each (constraint, variable, value) and re-checks it before
+                searching for a new one; this pays off when constraints
+                implement `BaseConstraint.find_support`.
+            heuristic: The variable ordering, as a key of `Search.HEURISTICS`
+                or a VariableHeuristic
+            restarts (str): None to never restart, or a key of
+                `Search.RESTARTS` for the restart schedule
+            seed: Seeds the random tie-breaks between equally good
+                variables; None breaks ties deterministically
+            workers (int): If more than 1, race a portfolio of this many
+                differently configured searches in separate processes; see
+                `solve_portfolio`. If decomposing, solve up to this many
+                components at once in separate processes instead.
+            tracer (SearchTracer): Notified of the search's assignments,
+                backtracks and wipeouts; ignored by a portfolio
+            profile (bool): If True, also time each constraint class's
+                revisions, in `stats.time`
+            timeout (float): Give up after this many seconds, or None to
+                search until done. The initial propagation isn't interrupted.
+            node_limit (int): Give up after visiting this many nodes (per
+                worker, in a portfolio), or None for no limit
+            cancel (CancellationToken): Give up when this is cancelled, e.g.
+                from another thread
+            decompose (bool): If True, search each connected component of
+                the constraint graph (see `components`) separately, so that
+                a failure in one never backjumps through decisions in
+                another. The statistics are totalled over the components,
+                and node_limit applies to each one.
+            value_order (str): The order to try each variable's values in, a
+                key of `Search.VALUE_ORDERS`
+
         Returns:
             The CSP with values assigned to all its non-auxiliary variables,
-            or None if there is no solution.
+            or None if there is no solution or the search gave up first;
+            `self.status` tells these apart. Either way, the search's
+            statistics are left in `self.stats`.
         """
-        self._ac3()
-        return self._recursive_backtracking(0)
+        if decompose:
+            return self._solve_components(propagation, heuristic, restarts, seed, workers,
+                                          tracer, profile, timeout, node_limit, cancel,
+                                          value_order)
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        if workers is not None and workers > 1:
+            return self.solve_portfolio(workers, propagation, heuristic=heuristic,
+                                        restarts=restarts, seed=seed, profile=profile,
+                                        timeout=timeout, node_limit=node_limit,
+                                        cancel=cancel, value_order=value_order)
+
+        search = Search(self, propagation, heuristic=heuristic, restarts=restarts,
+                        seed=seed, tracer=tracer, profile=profile, value_order=value_order)
+        return self._finish(search, search.run(node_limit, deadline, cancel))
+
+    async def solve_async(self, propagation='ac3', heuristic='mrv', restarts=None,
+                          seed=None, profile=False, timeout=None, node_limit=None,
+                          cancel=None, executor=None, slice_nodes=100, value_order='domain'):
+        """
+        Solve the problem without blocking the asyncio event loop.
+
+        By default the search runs on the event loop itself, slice_nodes
+        nodes at a time, and yields to the loop between slices, so many
+        solves can share one loop. With an executor, the whole solve runs
+        there instead, e.g. in a thread pool.
+
+        Cancelling the awaiting task cancels the search as well.
 
-    def _recursive_backtracking(self, depth):
+        Args:
+            propagation, heuristic, restarts, seed, profile, timeout,
+                node_limit, cancel, value_order: As for `solve`
+            executor (concurrent.futures.Executor): Where to run the solve,
+                or None to interleave it with the event loop
+            slice_nodes (int): The number of nodes to visit between yields
+
+        Returns:
+            As for `solve`.
+        """
+        cancel = cancel if cancel is not None else CancellationToken()
+        try:
+            if executor is not None:
+                solve = functools.partial(
+                    self.solve, propagation, heuristic, restarts, seed, profile=profile,
+                    timeout=timeout, node_limit=node_limit, cancel=cancel,
+                    value_order=value_order)
+                return await asyncio.get_running_loop().run_in_executor(executor, solve)
+
+            deadline = time.perf_counter() + timeout if timeout is not None else None
+            search = Search(self, propagation, heuristic=heuristic, restarts=restarts,
+                            seed=seed, profile=profile, value_order=value_order)
+            while True:
+                budget = slice_nodes
+                if node_limit is not None:
+                    budget = min(budget, node_limit - search.nodes)
+                solved = search.run(budget, deadline, cancel)
+                if (solved is not None or cancel.cancelled
+                        or (node_limit is not None and search.nodes >= node_limit)
+                        or (deadline is not None and time.perf_counter() >= deadline)):
+                    return self._finish(search, solved)
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            cancel.cancel()
+            raise
+
+    def _finish(self, search, solved):
         """
-        Backtracking search.
+        Record the outcome of a solve's search.
 
         Args:
-            depth (int): The current depth of the search tree
+            search (Search): The search
+            solved: What `search.run` returned
 
         Returns:
-            self on success or the local conflict set on a branch fail. This
-                implies that the method returns something falsy if there is no
-                solution.
+            As for `solve`.
         """
-        if self.is_solved():
-            return self
+        self.stats = search.stats
+        if solved is None:
+            search.close()
+            self.status = 'unknown'
+            return None
+        self.status = 'solved' if solved else 'unsatisfiable'
+        return self if solved else None
+
+    def solve_portfolio(self, workers, propagation='ac3', heuristic='mrv',
+                        restarts=None, seed=None, profile=False, timeout=None,
+                        node_limit=None, cancel=None, value_order='domain'):
+        """
+        Solve the problem by racing differently configured searches in
+        separate processes.
+
+        The first worker searches exactly as `solve` would with the same
+        arguments. The others restart on the Luby schedule (unless restarts
+        names another schedule), alternate between the 'mrv' and 'dom/wdeg'
+        heuristics if heuristic is given by name, and use different seeds.
+        Every search is complete, so the first worker to finish decides the
+        answer and the others are terminated.
 
-        current_var = self._select_unassigned_variable()
-        current_var.conflict_set = {n for n in current_var.neighbors
-                                    if n.value is not None}
+        Workers are forked where the platform allows it, so the CSP isn't
+        pickled and its classes may be defined anywhere. Elsewhere the CSP
+        must be picklable. Only variable names and values, and the search's
+        statistics, are sent back, and they must be picklable.
 
-        for value in current_var.ordered_domain():
-            current_var.value = value
+        Args:
+            workers (int): The number of processes to run
+            propagation, heuristic, restarts, seed, profile, timeout,
+                node_limit, cancel, value_order: As for `solve`
 
-            # Record the values we're removing from each variable's domain.
-            reduced_domains = {current_var: {x for x in current_var.domain
-                                             if x is not value}}
-            current_var.domain = [value]
+        Returns:
+            The CSP with values assigned to all its non-auxiliary variables,
+            or None if there is no solution. The winning worker's statistics
+            are left in `self.stats`.
 
-            ac3_changes = self._ac3(current_var)
-            for (key, removed_values) in ac3_changes.items():
-                if key is current_var:
-                    reduced_domains[key].update(ac3_changes[key])
+        Raises:
+            RuntimeError: Every worker failed with an exception.
+        """
+        self._close_search()
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        base_seed = 0 if seed is None else seed
+        configs = [(heuristic, restarts, seed)]
+        for i in range(1, workers):
+            configs.append(((heuristic if not isinstance(heuristic, str)
+                             else ('mrv', 'dom/wdeg')[i % 2]),
+                            restarts or 'luby',
+                            base_seed + i))
+
+        jobs = [(self, i, propagation, h, r, s, profile, timeout, node_limit, value_order)
+                for (i, (h, r, s)) in enumerate(configs)]
+        reports = _run_in_processes(_solve_worker, jobs, workers, deadline, cancel)
+        try:
+            errors = list()
+            (outcome, payload, stats) = ('unknown', None, None)
+            for (_, result, data, data_stats) in reports:
+                if result == 'error':
+                    errors.append(data)
+                elif result == 'unknown':
+                    stats = data_stats
                 else:
-                    reduced_domains[key] = removed_values
+                    (outcome, payload, stats) = (result, data, data_stats)
+                    break
+            if len(errors) == len(jobs):
+                raise RuntimeError("Every worker failed:\n{}".format(errors[0]))
+        finally:
+            reports.close()
+
+        self.stats = stats
+        if outcome == 'unknown':
+            self.status = 'unknown'
+            return None
+        if payload is None:
+            self.status = 'unsatisfiable'
+            return None
+        self.status = 'solved'
+        self._search = _PinnedSolution(self, payload)
+        return self
+
+    def iter_solutions(self, limit=None, propagation='ac3'):
+        """
+        Enumerate the problem's solutions lazily.
+
+        The variables hold each solution's values while it's being yielded,
+        so don't modify the CSP until the generator is exhausted or closed.
+
+        Args:
+            limit (int): The maximum number of solutions to yield, or None to
+                yield all of them
+            propagation (str): The arc consistency algorithm to use, as in
+                `solve`
+
+        Yields:
+            A Solution mapping each non-auxiliary variable's name to its value.
+        """
+        names = tuple(name for (name, var) in self.variables.items() if not var.aux)
+        variables = tuple(self.variables[name] for name in names)
+        index = {name: i for (i, name) in enumerate(names)}
+
+        search = Search(self, propagation)
+        try:
+            while (limit is None or search.solutions < limit) and search.run():
+                yield Solution(index, tuple(var.value for var in variables))
+        finally:
+            search.close()
+            self.stats = search.stats
+
+    def count_solutions(self, limit=None, propagation='ac3', decompose=False, workers=None):
+        """
+        Count the problem's solutions without recording any of them.
+
+        Args:
+            limit (int): Stop counting at this many solutions, or None to
+                count all of them
+            propagation (str): The arc consistency algorithm to use, as in
+                `solve`
+            decompose (bool): If True, count the solutions of each connected
+                component of the constraint graph separately, and multiply
+                the counts
+            workers (int): If decomposing, count the components in up to this
+                many processes at once
+
+        Returns:
+            The number of solutions found.
+        """
+        if decompose:
+            return self._count_components(limit, propagation, workers)
+        search = Search(self, propagation)
+        while (limit is None or search.solutions < limit) and search.run():
+            pass
+        search.close()
+        self.stats = search.stats
+        return search.solutions
+
+    def components(self):
+        """
+        Split the problem's variables into the connected components of the
+        constraint graph, whose parts share no constraint and so can be
+        solved independently.
 
-            result = self._recursive_backtracking(depth + 1)
-            if result is self:
-                return self
+        Returns:
+            A list of lists of variables. Variables are listed in the order
+            of `self.variables`, and components in the order of their first
+            variables.
+        """
+        order = {var: i for (i, var) in enumerate(self.variables.values())}
+        seen = set()
+        components = list()
+        for start in self.variables.values():
+            if start in seen:
+                continue
+            seen.add(start)
+            component = [start]
+            for var in component:
+                for neighbor in var.neighbors:
+                    if neighbor not in seen:
+                        seen.add(neighbor)
+                        component.append(neighbor)
+            components.append(sorted(component, key=order.get))
+        return components
+
+    def _split(self):
+        """
+        Make a subproblem of each connected component, starting from this
+        problem's arc consistent root state.
 
-            # No value works at depth + 1, so de-assign current_var and undo
-            # all the domain modifications.
-            for (variable, removed_values) in reduced_domains.items():
-                variable.domain.extend(removed_values)
-            reduced_domains.clear()
-            current_var.value = None
+        The variables are moved to the subproblems, and `_merge` moves them
+        back. The subproblems share this problem's trail and assumptions, so
+        what their searches remove at the root is undone along with the
+        assumptions, like this problem's own removals.
 
-            # If the current variable isn't in the conflict set from recursion
-            # depth + 1, then no value will satisfy this constraint. So
-            # backtrack and pass the conflict set up to the next stack frame.
-            if current_var not in result and depth > 0:
-                return result
+        Returns:
+            A list of ConstraintSatisfactionProblems, or None if the root
+            state has a wiped out domain.
+        """
+        self._close_search()
+        if not (self._propagate_root()
+                and all(assumption.consistent for assumption in self._assumptions)):
+            return None
+        names = {var: name for (name, var) in self.variables.items()}
+        subproblems = list()
+        for component in self.components():
+            sub = ConstraintSatisfactionProblem()
+            sub.is_disjoint_constraints = self.is_disjoint_constraints
+            sub.support_cache = self.support_cache
+            sub.variables = {names[var]: var for var in component}
+            sub.constraints = {c for var in component for c in var.constraints}
+            sub._trail = self._trail
+            sub._assumptions = self._assumptions
+            for var in component:
+                var.csp = sub
+            subproblems.append(sub)
+        return subproblems
+
+    def _merge(self):
+        """
+        Move the variables back from the subproblems made by `_split`.
+        """
+        for var in self.variables.values():
+            var.csp = self
 
-            # Otherwise absorb the conflict set from the previous recursion into
-            # current_var's conflict set.
-            for e in result:
-                if e is not current_var:
-                    current_var.conflict_set.add(e)
+    def _solve_components(self, propagation, heuristic, restarts, seed, workers, tracer,
+                          profile, timeout, node_limit, cancel, value_order):
+        """
+        Solve each connected component separately, in turn or in up to
+        workers processes at once, and combine the solutions; see `solve`.
+        """
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        stats = self._stats = SolverStats(profile)
+        start = time.perf_counter()
+        subproblems = self._split()
+        stats.elapsed += time.perf_counter() - start
+        outcome = 'unsatisfiable' if subproblems is None else 'solved'
+        assignment = dict()
+        try:
+            if subproblems is None:
+                pass
+            elif workers is not None and workers > 1:
+                jobs = [(sub, i, propagation, heuristic, restarts, seed, profile, timeout,
+                         node_limit, value_order) for (i, sub) in enumerate(subproblems)]
+                reports = _run_in_processes(_solve_worker, jobs, workers, deadline, cancel)
+                reported = 0
+                try:
+                    for (_, result, data, data_stats) in reports:
+                        reported += 1
+                        if result == 'error':
+                            raise RuntimeError("A worker failed:\n{}".format(data))
+                        stats.add(data_stats)
+                        if result == 'unknown':
+                            outcome = 'unknown'
+                        elif data is None:
+                            outcome = 'unsatisfiable'
+                            break
+                        else:
+                            assignment.update(data)
+                finally:
+                    reports.close()
+                if outcome == 'solved' and reported < len(jobs):
+                    outcome = 'unknown'
+            else:
+                for sub in subproblems:
+                    search = Search(sub, propagation, heuristic=heuristic, restarts=restarts,
+                                    seed=seed, tracer=tracer, profile=profile,
+                                    value_order=value_order)
+                    solved = search.run(node_limit, deadline, cancel)
+                    if solved:
+                        assignment.update((name, var.value) for (name, var) in sub.variables.items())
+                    search.close()
+                    stats.add(search.stats)
+                    if not solved:
+                        outcome = 'unknown' if solved is None else 'unsatisfiable'
+                        break
+        finally:
+            self._merge()
+
+        stats.solutions = 1 if outcome == 'solved' else 0
+        self.stats = stats
+        self.status = outcome
+        if outcome != 'solved':
+            return None
+        self._search = _PinnedSolution(self, assignment)
+        return self
+
+    def _count_components(self, limit, propagation, workers):
+        """
+        Count the solutions of each connected component separately, in turn
+        or in up to workers processes at once, and multiply the counts; see
+        `count_solutions`.
 
-        return current_var.conflict_set
+        Each component's count is capped at the limit too, which leaves the
+        product right up to the limit.
+        """
+        stats = self._stats = SolverStats()
+        start = time.perf_counter()
+        subproblems = self._split()
+        stats.elapsed += time.perf_counter() - start
+        total = 0 if subproblems is None else 1
+        try:
+            if subproblems is None:
+                pass
+            elif workers is not None and workers > 1:
+                jobs = [(sub, i, propagation, limit) for (i, sub) in enumerate(subproblems)]
+                reports = _run_in_processes(_count_worker, jobs, workers)
+                try:
+                    for (_, result, data, data_stats) in reports:
+                        if result == 'error':
+                            raise RuntimeError("A worker failed:\n{}".format(data))
+                        stats.add(data_stats)
+                        total *= data
+                        if not total:
+                            break
+                finally:
+                    reports.close()
+            else:
+                for sub in subproblems:
+                    search = Search(sub, propagation)
+                    while (limit is None or search.solutions < limit) and search.run():
+                        pass
+                    search.close()
+                    stats.add(search.stats)
+                    total *= search.solutions
+                    if not total:
+                        break
+        finally:
+            self._merge()
+
+        if limit is not None:
+            total = min(total, limit)
+        stats.solutions = total
+        self.stats = stats
+        return total
 
     def _ac3(self, variable=None):
         """
@@ -108,67 +802,116 @@ class ConstraintSatisfactionProblem:
                 to be considered. Passing None initializes the AC-3 queue with
                 the Cartesian product of all variables and all constraints.
 
+        Every reduction of a variable's domain is explained by the decisions
+        (assigned variables) it depends on, and the explanation is added to
+        the variable's culprit mask.
+
+        Propagation stops as soon as a domain is wiped out, and the
+        (variable, constraint) arc that emptied it is left in `_wipeout`.
+
         Returns:
-            A multimap of variables V -> a set of values removed from the
-                domain of V
+            The set of variables whose domains were reduced.
         """
+        if variable is None:
+            self._ensure_frozen()
+        elif self.arc_index is None:
+            self.freeze()
+        self._wipeout = None
+
+        # The set mirrors the queue's contents so that enqueueing an arc that
+        # is already waiting costs O(1) instead of a scan of the deque. A
+        # global constraint is queued once, as (None, constraint), instead of
+        # once per variable.
         queue = deque()
-
-        find_constraints = (BaseVariable.find_constraints_between
-                            if self.is_disjoint_constraints
-                            else BaseVariable.find_constraint_between)
-
-        for c in (self.constraints
-                  if variable is None
-                  else variable.constraints):
-            queue.extend((vi, c) for vi in c.get_variables()
-                         if vi.value is None)
-
-        removed = dict()
+        queued = set()
+
+        for c in self._constraint_order[variable]:
+            if c.is_global:
+                if (None, c) not in queued:
+                    queue.append((None, c))
+                    queued.add((None, c))
+                continue
+            for vi in c.get_variables():
+                if vi.value is None and (vi, c) not in queued:
+                    queue.append((vi, c))
+                    queued.add((vi, c))
+
+        revise = (self._remove_inconsistent_values_rm
+                  if self.propagation == 'ac3rm'
+                  else self._remove_inconsistent_values)
+
+        order = self._order
+        culprits = self._culprits
+        stats = self._stats
+        clock = time.perf_counter if stats is not None and stats.profile else None
+
+        reduced = set()
         while queue:
-            (variable, constraint) = queue.popleft()
-            inconsistent_values = self._remove_inconsistent_values(
-                    variable, constraint)
-
-            if inconsistent_values:
-                if variable in removed:
-                    removed[variable].update(inconsistent_values)
-                else:
-                    removed[variable] = inconsistent_values
-
-                for neighbor in variable.neighbors:
-                    for cst in find_constraints(variable, neighbor):
-                        if (neighbor, cst) not in queue:
-                            queue.append((neighbor, cst))
-        return removed
-
-    def _select_unassigned_variable(self):
+            arc = queue.popleft()
+            queued.discard(arc)
+            (variable, constraint) = arc
+
+            if clock is not None:
+                start = clock()
+            if variable is None:
+                removed = self._filter(constraint)
+                changed = list(removed)
+            else:
+                removed = revise(variable, constraint)
+                changed = (variable,) if removed else ()
+            if stats is not None:
+                stats.record(constraint, removed, clock() - start if clock is not None else None)
+            if not changed:
+                continue
+
+            # A global constraint's filtering is idempotent, so it doesn't
+            # need to be queued again for its own removals.
+            skip = constraint if constraint.is_global else None
+
+            for var in changed:
+                reduced.add(var)
+
+                # The removed values had no support among the other
+                # variables' domains, which are themselves explained by
+                # their culprits or, if assigned, by their own decision.
+                explanation = 0
+                for other in constraint.variables:
+                    if other is not var:
+                        explanation |= culprits[other].bits
+                        if other.value is not None:
+                            explanation |= 1 << order[other]
+                culprit = culprits[var]
+                if explanation & ~culprit.bits:
+                    self._set_bits(culprit, culprit.bits | explanation)
+
+                if not var.domain:
+                    self._wipeout = (var, constraint)
+                    return reduced
+
+                arcs = self._arcs.get(var)
+                if arcs is None:
+                    arcs = self._arcs[var] = self._arcs_of(var)
+                for (arc, cst) in arcs:
+                    if cst is not skip and arc not in queued:
+                        queue.append(arc)
+                        queued.add(arc)
+        return reduced
+
+    def _arcs_of(self, variable):
         """
-        Choose the next variable to examine.
+        Get the arcs to queue when a variable's domain is reduced, as
+        (arc, constraint) pairs, in the order of `arc_index`.
 
-        Most-restricted variable selection algorithm: Choose the
-        variable with the smallest domain, breaking ties in favor
-        of the variable that appears in more constraints.
-
-        Returns:
-            The next variable to examine.
+        A global constraint is listed once, not once for each neighbor it
+        covers.
         """
-        the_variables = [var for var in self.variables.values()
-                         if var.value is None]
-        assert(len(the_variables))
+        arcs = dict()
+        for (neighbor, shared) in self.arc_index[variable].items():
+            for cst in shared:
+                arcs.setdefault((None, cst) if cst.is_global else (neighbor, cst), cst)
+        return list(arcs.items())
 
-        choice = None
-        for var in the_variables:
-            if not choice or len(var.domain) < len(choice.domain):
-                choice = var
-            elif len(var.domain) == len(choice.domain):
-                if len([x for x in var.neighbors if not x.value]) > len(
-                        [x for x in choice.neighbors if not x.value]):
-                    choice = var
-        return choice
-
-    @staticmethod
-    def _remove_inconsistent_values(variable, constraint):
+    def _remove_inconsistent_values(self, variable, constraint):
         """
         Remove values from variable.domain that are inconsistent with constraint.
 
@@ -177,187 +920,2775 @@ class ConstraintSatisfactionProblem:
             constraint: The constraint we're checking the variable against
 
         Returns:
-            The set of inconsistent domain values.
+            The mask of inconsistent domain values, 0 if there are none.
         """
-        inconsistent = set()
-        for value in variable.domain:
+        if self.support_cache is not None and constraint.cacheable:
+            return self._remove_inconsistent_values_cached(variable, constraint)
+
+        domain = variable.domain
+        index = domain.index
+        inconsistent = 0
+        for value in domain:
             if not constraint.is_satisfiable(variable, value):
-                inconsistent.add(value)
+                inconsistent |= 1 << index[value]
 
-        variable.domain = [x for x in variable.domain if x not in inconsistent]
+        if inconsistent:
+            self._set_bits(domain, domain.bits & ~inconsistent)
         return inconsistent
 
-    def is_solved(self):
+    def _remove_inconsistent_values_cached(self, variable, constraint):
         """
-        Determine if the puzzle is solved.
+        Remove values from variable.domain that are inconsistent with
+        constraint, reusing the answers `support_cache` holds for the
+        current domains of the constraint's other variables.
 
         Returns:
-            True iff for all variables V in self.variable, V is assigned
-                a non-None value or V is an auxiliary variable.
+            The mask of inconsistent domain values, 0 if there are none.
         """
-        return all(var.value is not None for var in self.variables.values() if not var.aux)
-
+        cache = self.support_cache
+        domain = variable.domain
+        key = (constraint, variable,
+               tuple(v.domain.bits for v in constraint.variables if v is not variable))
+
+        # The entry is [mask of values checked, mask of those unsupported].
+        entry = cache.get(key)
+        if entry is None:
+            entry = [0, 0]
+            cache.put(key, entry)
+        unchecked = domain.bits & ~entry[0]
+        cache.hits += popcount(domain.bits) - popcount(unchecked)
+        if unchecked:
+            cache.misses += popcount(unchecked)
+            universe = domain.universe
+            bits = unchecked
+            while bits:
+                low = bits & -bits
+                if not constraint.is_satisfiable(variable, universe[low.bit_length() - 1]):
+                    entry[1] |= low
+                bits ^= low
+            entry[0] |= unchecked
+
+        inconsistent = domain.bits & entry[1]
+        if inconsistent:
+            self._set_bits(domain, domain.bits & ~inconsistent)
+        return inconsistent
 
-class BaseVariable:
-    """
-    A variable in the CSP.
+    def _remove_inconsistent_values_rm(self, variable, constraint):
+        """
+        Remove values from variable.domain that are inconsistent with
+        constraint, using residual supports (AC-3rm).
 
-    Attributes:
-        csp: A reference to the CSP wrapping this variable
-        name: An immutable, hashable representation of the variable
-        domain: The variable's domain of legal values at this stage in the
-            problem
-        value: The value assigned to this variable, possibly None
-        constraints: A set of constraints covering this variable
-        aux: An auxiliary variable isn't part of the problem. That is,
-            the problem can be said to be solved even if this variable's
-            value is still None.
-        
-    Note: If `v` is a BaseVariable and `k` is not `None`, then `v.value == k` implies
-    `list(v.domain) == [k]`.
-    """
-    def __init__(self, csp, name, aux=False):
-        self.csp = csp
-        self.name = name
-        self.domain = None
-        self.value = None
-        self.constraints = set()
-        self._neighbors = None
-        self.aux = aux
+        A support found for one value is also recorded as the residue of every
+        other (variable, value) pair in the supporting tuple.
 
-    @property
-    def neighbors(self):
-        """
-        Get all the variables that share at least one constraint with this variable.
+        Args:
+            variable: The variable whose domain we're checking
+            constraint: The constraint we're checking the variable against
 
         Returns:
-            A set of this variable's neighbors, not including self.
+            The mask of inconsistent domain values, 0 if there are none.
         """
-        if self._neighbors is None:
-            self._neighbors = set()
-            for c in self.constraints:
-                self._neighbors |= {v for v in c.variables if v is not self}
-        return self._neighbors
+        residues = self._residues
+        domain = variable.domain
+        index = domain.index
+        inconsistent = 0
+        for value in domain:
+            residue = residues.get((constraint, variable, value))
+            if residue is not None and constraint.is_valid_support(residue):
+                continue
+
+            support = constraint.find_support(variable, value)
+            if support is None:
+                inconsistent |= 1 << index[value]
+            elif support:
+                for (v, x) in zip(constraint.variables, support):
+                    residues[(constraint, v, x)] = support
+
+        if inconsistent:
+            self._set_bits(domain, domain.bits & ~inconsistent)
+        return inconsistent
 
-    def ordered_domain(self):
+    def _filter(self, constraint):
         """
-        Get this variable's domain as an indexable collection.
+        Remove the values a global constraint filters out of its variables'
+        domains.
 
-        Note that the code implies all values in the domain are consistent
-        with all constraints in the problem.
+        Args:
+            constraint: A constraint whose `is_global` is True
 
         Returns:
-            A (sorted) list of this variable's domain.
+            A dict of variable -> mask of the values removed from its domain,
+            for the variables whose domains were reduced.
         """
-        return self.domain
-
-    def find_constraints_between(self, other_var):
+        changed = dict()
+        for (var, removed) in constraint.filter().items():
+            domain = var.domain
+            removed &= domain.bits
+            if removed:
+                self._set_bits(domain, domain.bits & ~removed)
+                changed[var] = removed
+        return changed
+
+    def _set_bits(self, holder, bits):
         """
-        Find all the constraints covered by both of two given variables.
+        Replace a reversible bitmask, recording its old value on the trail.
 
         Args:
-            other_var: The other variable we're looking for in each constraint.
-
-        Returns:
-            A list of the shared constraints.
+            holder: An object with a `bits` attribute, usually a BitsetDomain
+            bits (int): The new mask
         """
-        return [c for c in self.constraints if c.covers(other_var)]
+        self._trail.append((holder, holder.bits))
+        holder.bits = bits
 
-    def find_constraint_between(self, other_var):
+    def _undo(self, mark):
         """
-        For a "linear" CSP, return the only constraint that covers two given variables.
+        Restore every mask changed since the trail had length mark.
 
         Args:
-            other_var: The other variable we're looking for in each constraint
-
-        Returns:
-            A singleton list of the shared constraint, or an empty list if
-            no shared constraint exists.
+            mark (int): The length of the trail to return to
         """
-        for c in self.constraints:
-            if c.covers(other_var):
-                return [c]
-        return list()
+        trail = self._trail
+        while len(trail) > mark:
+            (holder, bits) = trail.pop()
+            holder.bits = bits
 
-    def get_name(self):
+    def is_solved(self):
         """
-        A convenience method for sorting variables in a list.
+        Determine if the puzzle is solved.
+
+        Returns:
+            True iff for all variables V in self.variable, V is assigned
+                a non-None value or V is an auxiliary variable.
         """
-        return self.name
+        return all(var.value is not None for var in self.variables.values() if not var.aux)
 
-    def __hash__(self):
-        return object.__hash__(self.name)
 
-    def __eq__(self, other):
-        return self.name == other.name
+def popcount(bits):
+    """
+    Count the set bits of a non-negative integer.
+    """
+    return bin(bits).count('1')
 
-    def __repr__(self):
-        return "[Variable] {} => {}".format(
-            self.name, self.value if self.value is not None else self.domain)
 
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
 
-class BaseConstraint:
+
+class BitsetDomain:
     """
-    A constraint in the CSP.
+    A finite domain stored as a bitmask over a fixed universe of values.
+
+    Bit i of `bits` is set iff `universe[i]` is in the domain, so membership,
+    size, removal and intersection are integer operations. Domains of one
+    problem built from the same values share one universe and index, which
+    makes their masks directly comparable.
 
     Attributes:
-        variables: A list of variables this constraint covers
+        universe (tuple): Every value the domain can hold, in iteration order
+        index (dict): A mapping of value -> bit position in the universe
+        bits (int): The mask of values currently in the domain
     """
-    def __init__(self, variables):
+    __slots__ = ('universe', 'index', 'bits')
+
+    def __init__(self, values, universe=None, universes=None):
         """
         Constructor.
 
         Args:
-            variables: An iterable of variables this constraint covers
+            values: An iterable of the values in the domain
+            universe: A BitsetDomain whose universe this domain should share,
+                or None to use `values` as the universe
+            universes (dict): Where to intern a new universe, as a mapping of
+                universe -> (universe, index), usually a problem's
+                `_universes`; None not to share it
         """
-        self.variables = list(variables)
-        for variable in self.variables:
-            variable.constraints.add(self)
+        if universe is None:
+            key = tuple(dict.fromkeys(values))
+            if universes is None:
+                (self.universe, self.index) = (key, {v: i for (i, v) in enumerate(key)})
+            else:
+                (self.universe, self.index) = universes.setdefault(
+                    key, (key, {v: i for (i, v) in enumerate(key)}))
+            self.bits = (1 << len(key)) - 1
+        else:
+            self.universe = universe.universe
+            self.index = universe.index
+            self.bits = self.mask(values)
+
+    def mask(self, values):
+        """
+        Get the mask of the given values.
 
-    def is_satisfiable(self, variable, assignment):
+        Raises:
+            KeyError: A value is not in the universe.
         """
-        Determine if variable.value = assignment is satisfiable with the constraint.
+        index = self.index
+        bits = 0
+        for value in values:
+            bits |= 1 << index[value]
+        return bits
 
-        This is an abstract method that should be implemented by subclasses.
+    def copy(self):
+        """
+        Get a new domain over the same universe with the same values.
+        """
+        domain = BitsetDomain.__new__(BitsetDomain)
+        domain.universe = self.universe
+        domain.index = self.index
+        domain.bits = self.bits
+        return domain
 
-        Arguments:
-            variable: The variable we're assigning to
-            assignment: The value we're assigning to the variable
+    def discard(self, value):
         """
-        raise NotImplementedError
+        Remove value from the domain if it's present.
+        """
+        i = self.index.get(value)
+        if i is not None:
+            self.bits &= ~(1 << i)
 
-    def covers(self, variable):
+    def remove(self, value):
         """
-        Determine if this constraint covers the given variable.
+        Remove value from the domain.
 
-        Args:
-            variable: The variable we're checking against this constraint
+        Raises:
+            KeyError: value isn't in the domain.
+        """
+        if value not in self:
+            raise KeyError(value)
+        self.discard(value)
 
-        Returns:
-            True iff this constraint covers the given variable.
+    def update(self, values):
         """
-        return variable in self.variables
+        Add values, all of which must be in the universe, to the domain.
+        """
+        self.bits |= self.mask(values)
 
-    def get_variables(self):
+    def difference_update(self, values):
         """
-        Get all the variables this constraint covers.
+        Remove every one of values from the domain.
+        """
+        self.bits &= ~self.mask(v for v in values if v in self.index)
 
-        Returns:
-            A list of variables this constraint covers.
+    def intersection_update(self, values):
         """
-        return self.variables
+        Remove every value that isn't also in values from the domain.
+        """
+        if isinstance(values, BitsetDomain) and values.index is self.index:
+            self.bits &= values.bits
+        else:
+            self.bits &= self.mask(v for v in values if v in self.index)
+
+    def __and__(self, other):
+        domain = self.copy()
+        domain.intersection_update(other)
+        return domain
+
+    def __contains__(self, value):
+        i = self.index.get(value)
+        return i is not None and (self.bits >> i) & 1 == 1
+
+    def __len__(self):
+        return popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __iter__(self):
+        universe = self.universe
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield universe[low.bit_length() - 1]
+            bits ^= low
 
+    def __eq__(self, other):
+        if isinstance(other, BitsetDomain):
+            if other.index is self.index:
+                return self.bits == other.bits
+            return set(self) == set(other)
+        return NotImplemented
 
-class AllDifferentConstraint(BaseConstraint):
+    __hash__ = None
+
+    def __repr__(self):
+        return "{{{}}}".format(', '.join(repr(v) for v in self))
+
+
+def _solve_worker(csp, index, propagation, heuristic, restarts, seed, profile,
+                  timeout, node_limit, value_order, results):
     """
-    A constraint that is satisfied iff all the variables it covers are assigned
-    different values.
+    Run one search of a portfolio and report its outcome on results.
+
+    The outcome is ('solved', {name: value}, stats) or ('solved', None,
+    stats) if there's no solution, ('unknown', None, stats) if the search
+    ran out of time or nodes, or ('error', traceback, None) if it raised.
     """
-    def is_satisfiable(self, variable, assignment):
-        if assignment not in variable.domain:
-            return False
+    try:
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        search = Search(csp, propagation, heuristic=heuristic, restarts=restarts,
+                        seed=seed, profile=profile, value_order=value_order)
+        solved = search.run(node_limit, deadline)
+        if solved is None:
+            results.put((index, 'unknown', None, search.stats))
+            return
+        if solved:
+            payload = {name: var.value for (name, var) in csp.variables.items()}
+        else:
+            payload = None
+        results.put((index, 'solved', payload, search.stats))
+    except Exception:
+        results.put((index, 'error', traceback.format_exc(), None))
+
+
+def _count_worker(csp, index, propagation, limit, results):
+    """
+    Count the solutions of one component and report them on results, as
+    (index, 'counted', count, stats), or ('error', traceback, None) if the
+    count raised.
+    """
+    try:
+        search = Search(csp, propagation)
+        while (limit is None or search.solutions < limit) and search.run():
+            pass
+        results.put((index, 'counted', search.solutions, search.stats))
+    except Exception:
+        results.put((index, 'error', traceback.format_exc(), None))
 
-        return all(k is variable or any(d != assignment for d in k.domain) for k in self.variables)
 
-    def __repr__(self):
-        return "[AllDifferentConstraint]: {}".format(self.variables)
\ No newline at end of file
+def _run_in_processes(target, jobs, workers, deadline=None, cancel=None):
+    """
+    Call target(*job, results) for each job in a process of its own, with
+    at most workers of them running at once, and yield whatever they put
+    on the results queue as it arrives.
+
+    Processes are forked where the platform allows it, so the jobs aren't
+    pickled. Elsewhere they must be picklable. Each target must put exactly
+    one result on the queue.
+
+    The generator stops early at the deadline (a `time.perf_counter` time)
+    or once cancel is cancelled. When it's closed or exhausted, the
+    processes still running are terminated.
+
+    Raises:
+        RuntimeError: A process exited without putting its result, for
+            instance because it was killed by a signal.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    results = context.Queue()
+    waiting = deque(jobs)
+    processes = list()
+    pending = len(waiting)
+    try:
+        while pending:
+            # A process that reported may not have exited yet, so count the
+            # running ones by their results.
+            while waiting and len(processes) - (len(jobs) - pending) < workers:
+                process = context.Process(target=target, args=waiting.popleft() + (results,),
+                                          daemon=True)
+                process.start()
+                processes.append(process)
+
+            # Wake up now and then to check the deadline, the token and the
+            # processes.
+            wait = 0.05
+            if deadline is not None:
+                wait = min(wait, deadline - time.perf_counter())
+            if (cancel is not None and cancel.cancelled) or wait <= 0:
+                return
+            # A process puts its result before it exits, so once the queue
+            # is empty, every process that had exited before must have
+            # reported.
+            exited = sum(1 for process in processes if process.exitcode is not None)
+            try:
+                result = results.get(timeout=wait)
+            except queue.Empty:
+                if exited > len(jobs) - pending:
+                    raise RuntimeError("A worker process exited without a result, with codes {}".format(
+                        [process.exitcode for process in processes if process.exitcode]))
+                continue
+            pending -= 1
+            yield result
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        results.close()
+
+
+class _PinnedSolution:
+    """
+    A solution found outside a problem's own search, by worker processes or
+    in subproblems, assigned to its variables. Each domain is narrowed to
+    its value on the trail, and the solution stands in for the problem's
+    open search, so that closing it undoes the solution as closing a search
+    would.
+    """
+
+    def __init__(self, csp, values):
+        """
+        Constructor.
+
+        Args:
+            csp (ConstraintSatisfactionProblem): The problem, with no search
+                open
+            values (dict): A mapping of variable name -> value
+        """
+        self.csp = csp
+        self.mark = len(csp._trail)
+        self.variables = [csp.variables[name] for name in values]
+        for (var, value) in zip(self.variables, values.values()):
+            var.value = value
+            if value is not None:
+                csp._set_bits(var.domain, 1 << var.domain.index[value])
+
+    def close(self):
+        """
+        Unassign the variables and restore their domains.
+        """
+        for var in self.variables:
+            var.value = None
+        self.csp._undo(self.mark)
+
+
+class Search:
+    """
+    Conflict-directed backjumping search over a CSP, run on an explicit stack.
+
+    The search can be stopped after any number of nodes and resumed later
+    by calling `run` again. All of its state lives in this object and the
+    CSP, so a paused search can be pickled as a checkpoint, provided the
+    CSP's variable and constraint classes can be pickled.
+
+    Calling `run` after it finds a solution continues the search to the next
+    solution.
+
+    With a restart schedule, the search abandons its current branch after a
+    number of failures that grows with each restart, and starts again from
+    the root. Before it does, every value it has refuted is recorded as a
+    nogood: the decisions above the value imply that the variable can't take
+    it. The nogoods prune those values from then on, so no part of the search
+    space is explored twice. Restarts stop once a solution has been found.
+
+    Attributes:
+        csp: The problem being searched
+        heuristic (VariableHeuristic): Chooses the variable at each node
+        value_order (str): How the values of each variable are ordered, a key
+            of `VALUE_ORDERS`
+        status (str): 'paused' while the search is stopped between
+            solutions, 'solved' when the variables hold a solution, and
+            'exhausted' once every solution has been found
+        nodes (int): The number of search nodes visited so far
+        failures (int): The number of failed nodes and domain wipeouts
+        restarts (int): The number of restarts so far
+        solutions (int): The number of solutions found so far
+        nogoods (list): The recorded nogoods, as (decisions, variable, value)
+            tuples where decisions is a tuple of (variable, value) pairs
+        rank (dict): A mapping of variable -> position used to break ties
+            between variables the heuristic rates equally
+        tracer (SearchTracer): Notified of assignments, backtracks and
+            wipeouts, or None
+    """
+    HEURISTICS = dict()
+
+    RESTARTS = {
+        'luby': lambda i: luby(i + 1),
+        'geometric': lambda i: 1.5 ** i,
+    }
+
+    VALUE_ORDERS = {
+        'domain': lambda var: var.ordered_domain(),
+        'lcv': lambda var: var.least_constraining_values(),
+    }
+
+    def __init__(self, csp, propagation='ac3', heuristic='mrv', restarts=None,
+                 restart_scale=100, seed=None, tracer=None, profile=False,
+                 value_order='domain'):
+        """
+        Constructor. Freezes the CSP and makes it arc consistent.
+
+        Args:
+            csp: The problem to search
+            propagation (str): The arc consistency algorithm to use, one of
+                `ConstraintSatisfactionProblem.PROPAGATION_MODES`
+            heuristic: A key of `HEURISTICS` or a VariableHeuristic
+            restarts (str): A key of `RESTARTS`, or None to never restart
+            restart_scale (int): The number of failures allowed before the
+                first restart; the schedule multiplies it
+            seed: Seeds random tie-breaks between variables, or None to break
+                ties by position in `csp.variables`
+            tracer (SearchTracer): Notified of assignments, backtracks and
+                wipeouts, or None
+            profile (bool): If True, time each constraint class's revisions
+            value_order (str): A key of `VALUE_ORDERS`: 'domain' tries each
+                variable's values in the order of its `ordered_domain`,
+                'lcv' in the order of its `least_constraining_values`
+        """
+        if propagation not in csp.PROPAGATION_MODES:
+            raise ValueError("Unknown propagation mode: {}".format(propagation))
+        if isinstance(heuristic, str):
+            if heuristic not in Search.HEURISTICS:
+                raise ValueError("Unknown heuristic: {}".format(heuristic))
+            heuristic = Search.HEURISTICS[heuristic]()
+        if restarts is not None and restarts not in Search.RESTARTS:
+            raise ValueError("Unknown restart schedule: {}".format(restarts))
+        if value_order not in Search.VALUE_ORDERS:
+            raise ValueError("Unknown value order: {}".format(value_order))
+
+        csp._close_search()
+        csp._search = self
+        csp.propagation = propagation
+        csp._residues = dict()
+        self._stats = csp._stats = SolverStats(profile)
+        start = time.perf_counter()
+
+        consistent = (csp._propagate_root()
+                      and all(assumption.consistent for assumption in csp._assumptions))
+
+        self.csp = csp
+        self.heuristic = heuristic
+        self.value_order = value_order
+        self.status = 'paused' if consistent else 'exhausted'
+        self.nodes = 0
+        self.failures = 0
+        self.restarts = 0
+        self.solutions = 0
+        self.nogoods = list()
+        self.rank = None
+        self.random = random.Random(seed) if seed is not None else None
+        self.tracer = tracer
+        self._stack = list()
+        self._conflicts = None
+        self._nogood_index = dict()
+        for (_, nogood) in csp._nogoods:
+            self._add_nogood(nogood)
+        self._schedule = restarts
+        self._restart_scale = restart_scale
+        self._cutoff = None
+        self._reset()
+        self._stats.elapsed += time.perf_counter() - start
+
+    @property
+    def stats(self):
+        """
+        The search's statistics so far, as a SolverStats.
+        """
+        stats = self._stats
+        stats.nodes = self.nodes
+        stats.failures = self.failures
+        stats.restarts = self.restarts
+        stats.solutions = self.solutions
+        return stats
+
+    def run(self, node_limit=None, deadline=None, cancel=None):
+        """
+        Run the search until it finds a solution, runs out of values to try,
+        visits node_limit more nodes, reaches the deadline, or is cancelled.
+
+        The deadline and the token are checked before each node.
+
+        Args:
+            node_limit (int): The maximum number of nodes to visit before
+                pausing, or None for no limit
+            deadline (float): A `time.perf_counter` time to pause at, or None
+            cancel (CancellationToken): Pause once this is cancelled
+
+        Returns:
+            True if the CSP is solved, False if it has no more solutions, or
+            None if the search paused first.
+        """
+        if self.status == 'exhausted':
+            return False
+
+        start = time.perf_counter()
+        try:
+            return self._run(node_limit, deadline, cancel)
+        finally:
+            self._stats.elapsed += time.perf_counter() - start
+
+    def _run(self, node_limit, deadline, cancel):
+        csp = self.csp
+        stack = self._stack
+        conflicts = self._conflicts
+        budget = node_limit
+        stats = self._stats
+        jumped = 0
+
+        if self.status == 'solved':
+            # Move on from the current solution. Every decision took part in
+            # it, so none of them may be jumped over.
+            if not stack:
+                self.status = 'exhausted'
+                return False
+            conflicts = 0
+            for frame in stack:
+                conflicts |= frame.bit
+            self.status = 'paused'
+
+        while True:
+            if conflicts is None:
+                # Expand a new node.
+                if self._unassigned == 0:
+                    self._conflicts = None
+                    self.status = 'solved'
+                    self.solutions += 1
+                    self._cutoff = None
+                    return True
+
+                if budget is not None:
+                    if budget == 0:
+                        self._conflicts = None
+                        return None
+                    budget -= 1
+                if ((deadline is not None and time.perf_counter() >= deadline)
+                        or (cancel is not None and cancel.cancelled)):
+                    self._conflicts = None
+                    return None
+                self.nodes += 1
+
+                # The node fails unless one of its values works, and the
+                # values it has lost are explained by its culprits.
+                var = self.heuristic.select(self)
+                stack.append(_Frame(var, list(Search.VALUE_ORDERS[self.value_order](var)),
+                                    1 << csp._order[var],
+                                    csp._culprits[var].bits))
+            else:
+                # The node below the top frame failed with this conflict set,
+                # so de-assign the top frame's variable and undo all the
+                # domain modifications.
+                frame = stack[-1]
+                var = frame.variable
+                self._unassign(frame)
+
+                # If the current variable isn't in the conflict set from the
+                # failed node, then no value will satisfy this constraint. So
+                # backjump and pass the conflict set up to the next frame.
+                if not conflicts & frame.bit and len(stack) > 1:
+                    stack.pop()
+                    jumped += 1
+                    continue
+
+                # Otherwise absorb the conflict set into the frame's.
+                frame.conflict_set |= conflicts & ~frame.bit
+                if jumped:
+                    stats.backjumps += 1
+                    stats.backjump_levels += jumped
+                    stats.max_backjump = max(stats.max_backjump, jumped)
+                    jumped = 0
+
+                if self._cutoff is not None and self._failed >= self._cutoff:
+                    conflicts = None
+                    if not self._restart():
+                        self._conflicts = None
+                        self.status = 'exhausted'
+                        return False
+                    continue
+
+            frame = stack[-1]
+            if frame.index == len(frame.values):
+                self.failures += 1
+                self._failed += 1
+                conflicts = frame.conflict_set
+                stack.pop()
+                if not stack:
+                    self._conflicts = None
+                    self.status = 'exhausted'
+                    return False
+                continue
+
+            value = frame.values[frame.index]
+            frame.index += 1
+            conflicts = self._assign(frame, value)
+            if conflicts is not None:
+                self.failures += 1
+                self._failed += 1
+
+    def _assign(self, frame, value):
+        """
+        Assign a value to the frame's variable and propagate it.
+
+        Returns:
+            None, or the conflict set if propagation wiped out a domain.
+        """
+        csp = self.csp
+        var = frame.variable
+        var.value = value
+        if not var.aux:
+            self._unassigned -= 1
+
+        # Every domain change below this point is recorded on the trail,
+        # so undoing the assignment is just popping back to the mark.
+        frame.mark = len(csp._trail)
+        domain = var.domain
+        csp._set_bits(domain, 1 << domain.index[value])
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.on_assign(self, var, value)
+
+        conflicts = None
+        reduced = set()
+        pruned = self._apply_nogoods(var, value)
+        for v in pruned:
+            reduced.add(v)
+            if not v.domain:
+                if tracer is not None:
+                    tracer.on_wipeout(self, v, None)
+                conflicts = self._explain(v)
+                break
+        else:
+            for v in [var] + pruned:
+                reduced |= csp._ac3(v)
+                if csp._wipeout is not None:
+                    (wiped, constraint) = csp._wipeout
+                    self.heuristic.wiped_out(self, wiped, constraint)
+                    if tracer is not None:
+                        tracer.on_wipeout(self, wiped, constraint)
+                    conflicts = self._explain(wiped)
+                    break
+
+        frame.reduced = reduced
+        self.heuristic.assigned(self, var, reduced)
+        return conflicts
+
+    def _unassign(self, frame):
+        """
+        Undo the frame's assignment and everything it propagated.
+        """
+        var = frame.variable
+        if self.tracer is not None:
+            self.tracer.on_backtrack(self, var, var.value)
+        self.csp._undo(frame.mark)
+        var.value = None
+        if not var.aux:
+            self._unassigned += 1
+        self.heuristic.unassigned(self, var, frame.reduced)
+
+    def _explain(self, variable):
+        """
+        Get the conflict set of a variable whose domain was wiped out.
+        """
+        conflicts = self.csp._culprits[variable].bits
+        if variable.value is not None:
+            conflicts |= 1 << self.csp._order[variable]
+        return conflicts
+
+    def _apply_nogoods(self, var, value):
+        """
+        Prune the values forbidden by nogoods that var = value completes.
+
+        Returns:
+            A list of the variables whose domains were reduced.
+        """
+        csp = self.csp
+        pruned = list()
+        for (decisions, target, refuted) in self._nogood_index.get((var, value), ()):
+            if not all(v.value == x for (v, x) in decisions):
+                continue
+            domain = target.domain
+            bit = 1 << domain.index[refuted]
+            if not domain.bits & bit:
+                continue
+
+            csp._set_bits(domain, domain.bits & ~bit)
+            explanation = 0
+            for (v, _) in decisions:
+                explanation |= 1 << csp._order[v]
+            culprit = csp._culprits[target]
+            if explanation & ~culprit.bits:
+                csp._set_bits(culprit, culprit.bits | explanation)
+            pruned.append(target)
+        return pruned
+
+    def _restart(self):
+        """
+        Record the refuted values as nogoods and start again from the root.
+
+        Returns:
+            False if the nogoods show that there's no solution, else True.
+        """
+        csp = self.csp
+        stack = self._stack
+        decisions = list()
+        root_nogoods = list()
+        for (k, frame) in enumerate(stack):
+            # The top frame's variable is unassigned, and every value it has
+            # tried is refuted. Lower frames are still trying their last one.
+            top = k == len(stack) - 1
+            for value in frame.values[:frame.index if top else frame.index - 1]:
+                nogood = (tuple(decisions), frame.variable, value)
+                self._add_nogood(nogood)
+                csp._nogoods.append((len(csp._assumptions), nogood))
+                if not decisions:
+                    root_nogoods.append(nogood)
+            if not top:
+                decisions.append((frame.variable, frame.variable.value))
+
+        self._unwind()
+        self.restarts += 1
+
+        # Values refuted at the root are gone for good.
+        for (_, target, value) in root_nogoods:
+            domain = target.domain
+            if value in domain:
+                csp._set_bits(domain, domain.bits & ~(1 << domain.index[value]))
+                csp._ac3(target)
+                if not domain or csp._wipeout is not None:
+                    return False
+        if not csp._assumptions:
+            del csp._trail[:]
+
+        self._reset()
+        return True
+
+    def _add_nogood(self, nogood):
+        """
+        Record a nogood and index it by its decisions.
+        """
+        self.nogoods.append(nogood)
+        for decision in nogood[0]:
+            self._nogood_index.setdefault(decision, list()).append(nogood)
+
+    def _reset(self):
+        """
+        Prepare the heuristic and restart cutoff for a search from the root.
+        """
+        csp = self.csp
+        self._unassigned = sum(1 for var in csp.variables.values()
+                               if var.value is None and not var.aux)
+        if self.random is None:
+            self.rank = csp._order
+        else:
+            positions = list(range(len(csp._order)))
+            self.random.shuffle(positions)
+            self.rank = dict(zip(csp._order, positions))
+
+        self._failed = 0
+        if self._schedule is not None:
+            self._cutoff = self._restart_scale * Search.RESTARTS[self._schedule](self.restarts)
+        self.heuristic.reset(self)
+
+    def _unwind(self):
+        """
+        Undo every decision on the stack.
+        """
+        for frame in self._stack:
+            frame.variable.value = None
+        if self._stack:
+            self.csp._undo(self._stack[0].mark)
+        del self._stack[:]
+        self._conflicts = None
+
+    def close(self):
+        """
+        Abandon the search, undoing every decision so that the CSP is left
+        as it was after the initial propagation.
+        """
+        self._unwind()
+        self.status = 'exhausted'
+
+
+def luby(i):
+    """
+    Get the i-th term of the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, ...
+
+    Args:
+        i (int): A positive index into the sequence
+    """
+    k = i.bit_length()
+    while i != (1 << k) - 1:
+        i -= (1 << (k - 1)) - 1
+        k = i.bit_length()
+    return 1 << (k - 1)
+
+
+class VariableHeuristic:
+    """
+    The base class of a variable ordering heuristic.
+
+    The search calls `reset` when it starts and after every restart, and
+    `select` at every node. It reports assignments, undone assignments and
+    domain wipeouts so that subclasses can keep their state up to date
+    incrementally.
+    """
+    def reset(self, search):
+        """
+        Rebuild the heuristic's state for a search starting from the root.
+        """
+        pass
+
+    def select(self, search):
+        """
+        Choose the next variable to examine.
+
+        Returns:
+            An unassigned variable of search.csp.
+        """
+        raise NotImplementedError
+
+    def assigned(self, search, variable, reduced):
+        """
+        variable has just been assigned, and propagating the assignment
+        reduced the domains of the variables in the set reduced.
+        """
+        pass
+
+    def unassigned(self, search, variable, reduced):
+        """
+        variable's assignment has just been undone, restoring the domains of
+        the variables in the set reduced.
+        """
+        pass
+
+    def wiped_out(self, search, variable, constraint):
+        """
+        Revising variable against constraint has just emptied its domain.
+        """
+        pass
+
+
+class MinimumRemainingValues(VariableHeuristic):
+    """
+    Most-restricted variable selection: choose the variable with the smallest
+    domain, breaking ties in favor of the variable with more unassigned
+    neighbors, then by `search.rank`.
+
+    The candidates are kept in a heap that is updated only for variables
+    whose domain or number of unassigned neighbors changes. Entries whose key
+    no longer matches their variable are discarded when they reach the top.
+    """
+    def reset(self, search):
+        variables = search.csp.variables.values()
+        self.rank = search.rank
+        self.degree = {var: sum(1 for n in var.neighbors if n.value is None)
+                       for var in variables}
+        self._rebuild_heap()
+
+    def select(self, search):
+        heap = self.heap
+        if len(heap) > 4 * len(self.degree) + 64:
+            self._rebuild_heap()
+            heap = self.heap
+
+        degree = self.degree
+        while heap:
+            (size, neg_degree, _, var) = heap[0]
+            if (var.value is None and size == len(var.domain)
+                    and neg_degree == -degree[var]):
+                return var
+            heapq.heappop(heap)
+        raise AssertionError("No unassigned variables")
+
+    def assigned(self, search, variable, reduced):
+        degree = self.degree
+        for n in variable.neighbors:
+            degree[n] -= 1
+            self._push(n)
+        for v in reduced:
+            self._push(v)
+
+    def unassigned(self, search, variable, reduced):
+        degree = self.degree
+        for n in variable.neighbors:
+            degree[n] += 1
+            self._push(n)
+        for v in reduced:
+            self._push(v)
+        self._push(variable)
+
+    def _push(self, var):
+        """
+        Add an entry for var under its current key if it's unassigned.
+        """
+        if var.value is None:
+            heapq.heappush(self.heap, (len(var.domain), -self.degree[var],
+                                       self.rank[var], var))
+
+    def _rebuild_heap(self):
+        """
+        Replace the heap with one current entry for each unassigned variable.
+        """
+        self.heap = [(len(var.domain), -self.degree[var], self.rank[var], var)
+                     for var in self.degree if var.value is None]
+        heapq.heapify(self.heap)
+
+
+class DomOverWDeg(VariableHeuristic):
+    """
+    Conflict-directed variable selection (dom/wdeg): choose the variable with
+    the smallest ratio of domain size to weighted degree, breaking ties by
+    `search.rank`.
+
+    Every constraint starts with weight 1, and its weight goes up by one
+    each time revising against it wipes out a domain. A variable's weighted
+    degree is the total weight of its constraints that cover at least one
+    other unassigned variable. Weights are kept across restarts, so the
+    search learns to start with the variables involved in hard constraints.
+
+    Attributes:
+        weights (dict): A mapping of constraint -> weight, for constraints
+            whose weight has been raised
+    """
+    def __init__(self):
+        self.weights = dict()
+
+    def select(self, search):
+        weights = self.weights
+        rank = search.rank
+        best = None
+        best_key = None
+        for var in search.csp.variables.values():
+            if var.value is not None:
+                continue
+            wdeg = 0
+            for c in var.constraints:
+                if any(v.value is None and v is not var for v in c.variables):
+                    wdeg += weights.get(c, 1)
+            key = (len(var.domain) / wdeg if wdeg else float('inf'), rank[var])
+            if best is None or key < best_key:
+                (best, best_key) = (var, key)
+        if best is None:
+            raise AssertionError("No unassigned variables")
+        return best
+
+    def wiped_out(self, search, variable, constraint):
+        self.weights[constraint] = self.weights.get(constraint, 1) + 1
+
+
+Search.HEURISTICS['mrv'] = MinimumRemainingValues
+Search.HEURISTICS['dom/wdeg'] = DomOverWDeg
+
+
+class SearchTracer:
+    """
+    The base class of an observer of a search, e.g. for logging or metrics.
+
+    Every hook does nothing by default, so subclasses only override the ones
+    they need. A search without a tracer doesn't pay for the calls.
+    """
+    def on_assign(self, search, variable, value):
+        """
+        Called when a value is assigned to a variable, before it's propagated.
+        """
+        pass
+
+    def on_backtrack(self, search, variable, value):
+        """
+        Called when a variable's assignment is undone, before its
+        propagation is.
+        """
+        pass
+
+    def on_wipeout(self, search, variable, constraint):
+        """
+        Called when propagation empties a variable's domain.
+
+        Args:
+            constraint: The constraint that removed the last value, or None
+                if a nogood did
+        """
+        pass
+
+
+class Assumption:
+    """
+    Assumptions added to a problem by `ConstraintSatisfactionProblem.assume`.
+
+    Used as a context manager, it retracts the assumptions on exit.
+
+    Attributes:
+        csp: The problem
+        mark (int): The length of the problem's trail before the assumptions
+        constraints (list): The extra constraints assumed
+        consistent (bool): False if propagating the assumptions wiped out a
+            domain
+    """
+    def __init__(self, csp, mark, constraints):
+        self.csp = csp
+        self.mark = mark
+        self.constraints = constraints
+        self.consistent = True
+
+    def retract(self):
+        """
+        Retract these assumptions, which must be the last ones added.
+        """
+        if not self.csp._assumptions or self.csp._assumptions[-1] is not self:
+            raise ValueError("Only the last assumptions added can be retracted")
+        self.csp.retract()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.retract()
+        return False
+
+
+class SupportCache:
+    """
+    A bounded cache of support checks, evicting the least recently used
+    entries first.
+
+    An entry answers every support check of one (constraint, variable)
+    under one state of the constraint's other variables' domains, so its
+    size grows with the constraint's arity. Set maxsize to cap the memory
+    it takes.
+
+    Attributes:
+        maxsize (int): The most entries kept
+        hits (int): The number of support checks answered from the cache
+        misses (int): The number of support checks computed
+        evictions (int): The number of entries evicted
+    """
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Get the entry for key and mark it as recently used, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        """
+        Add an entry, evicting the least recently used one if it's full.
+        """
+        self._entries[key] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry, keeping the counters.
+        """
+        self._entries.clear()
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of support checks answered from the cache.
+        """
+        checks = self.hits + self.misses
+        return self.hits / checks if checks else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "SupportCache(maxsize={}, entries={}, hits={}, misses={}, evictions={})".format(
+            self.maxsize, len(self), self.hits, self.misses, self.evictions)
+
+
+class CancellationToken:
+    """
+    A flag that asks the searches checking it to stop.
+
+    It may be cancelled from any thread.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """
+        Ask the searches to stop.
+        """
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        """
+        True once `cancel` has been called.
+        """
+        return self._event.is_set()
+
+
+class SolverStats:
+    """
+    Statistics about a search.
+
+    Per-constraint figures are keyed by constraint class name. A revision is
+    one check of a (variable, constraint) arc, or one filtering of a global
+    constraint.
+
+    Attributes:
+        profile (bool): Whether revisions are timed
+        nodes (int): The number of search nodes visited
+        failures (int): The number of failed nodes and domain wipeouts
+        restarts (int): The number of restarts
+        solutions (int): The number of solutions found
+        backjumps (int): The number of backtracks that skipped at least one
+            decision
+        backjump_levels (int): The total number of decisions skipped
+        max_backjump (int): The most decisions skipped at once
+        revisions (dict): Class name -> number of revisions
+        pruned (dict): Class name -> number of values removed
+        time (dict): Class name -> seconds spent revising, if profiling
+        elapsed (float): Seconds spent in the search, including the initial
+            propagation
+    """
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.nodes = 0
+        self.failures = 0
+        self.restarts = 0
+        self.solutions = 0
+        self.backjumps = 0
+        self.backjump_levels = 0
+        self.max_backjump = 0
+        self.revisions = dict()
+        self.pruned = dict()
+        self.time = dict()
+        self.elapsed = 0.0
+
+    def record(self, constraint, removed, elapsed=None):
+        """
+        Record a revision.
+
+        Args:
+            constraint: The constraint revised
+            removed: The mask of values removed from the revised variable, or
+                a dict of variable -> mask for a global constraint
+            elapsed (float): The seconds it took, or None
+        """
+        name = type(constraint).__name__
+        self.revisions[name] = self.revisions.get(name, 0) + 1
+        if removed:
+            count = (sum(popcount(mask) for mask in removed.values())
+                     if isinstance(removed, dict) else popcount(removed))
+            self.pruned[name] = self.pruned.get(name, 0) + count
+        if elapsed is not None:
+            self.time[name] = self.time.get(name, 0.0) + elapsed
+
+    def add(self, other):
+        """
+        Add another search's statistics to these, e.g. to total the searches
+        of a problem's components.
+
+        Returns:
+            self
+        """
+        for key in ('nodes', 'failures', 'restarts', 'solutions', 'backjumps',
+                    'backjump_levels', 'elapsed'):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        self.max_backjump = max(self.max_backjump, other.max_backjump)
+        for key in ('revisions', 'pruned', 'time'):
+            totals = getattr(self, key)
+            for (name, value) in getattr(other, key).items():
+                totals[name] = totals.get(name, 0) + value
+        return self
+
+    def as_dict(self):
+        """
+        Get the statistics as a dict of plain numbers and dicts, e.g. for
+        export as JSON.
+        """
+        return {key: (dict(value) if isinstance(value, dict) else value)
+                for (key, value) in vars(self).items()}
+
+    def __repr__(self):
+        return "SolverStats({})".format(', '.join(
+            '{}={!r}'.format(key, value) for (key, value) in vars(self).items()))
+
+
+class _Frame:
+    """
+    One level of the search stack: a variable and the values left to try.
+
+    Conflict sets are masks over the variables' positions in the CSP, and
+    bit is the mask of this frame's variable.
+    """
+    __slots__ = ('variable', 'values', 'index', 'mark', 'reduced', 'bit',
+                 'conflict_set')
+
+    def __init__(self, variable, values, bit, conflict_set):
+        self.variable = variable
+        self.values = values
+        self.index = 0
+        self.mark = None
+        self.reduced = None
+        self.bit = bit
+        self.conflict_set = conflict_set
+
+
+class _Mask:
+    """
+    A reversible bitmask that isn't a domain, for use with the trail.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+
+class Solution(Mapping):
+    """
+    An immutable snapshot of a solution: variable name -> assigned value.
+
+    Solutions from the same enumeration share their name index, so each one
+    costs a single tuple of values.
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        """
+        Constructor.
+
+        Args:
+            index (dict): A mapping of variable name -> position in values
+            values (tuple): The assigned values
+        """
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "[Solution] {}".format(dict(self))
+
+
+class BaseVariable:
+    """
+    A variable in the CSP.
+
+    Attributes:
+        csp: A reference to the CSP wrapping this variable
+        name: An immutable, hashable representation of the variable.
+            Variables compare and hash by identity, never by name.
+        domain (BitsetDomain): The variable's domain of legal values at this
+            stage in the problem. Assigning any other iterable converts it to
+            a BitsetDomain, over the current domain's universe if possible.
+        value: The value assigned to this variable, possibly None
+        constraints: A set of constraints covering this variable
+        aux: An auxiliary variable isn't part of the problem. That is,
+            the problem can be said to be solved even if this variable's
+            value is still None.
+        
+    Note: If `v` is a BaseVariable and `k` is not `None`, then `v.value == k` implies
+    `list(v.domain) == [k]`.
+    """
+    __slots__ = ('csp', 'name', '_domain', 'value', 'constraints',
+                 '_neighbors', 'aux')
+
+    def __init__(self, csp, name, aux=False):
+        self.csp = csp
+        self.name = name
+        self._domain = None
+        self.value = None
+        self.constraints = set()
+        self._neighbors = None
+        self.aux = aux
+
+    @property
+    def domain(self):
+        return self._domain
+
+    @domain.setter
+    def domain(self, values):
+        if self.csp is not None:
+            self.csp._root_consistent = False
+        if values is None or isinstance(values, BitsetDomain):
+            self._domain = values
+            return
+
+        values = list(values)
+        current = self._domain
+        if current is not None and all(v in current.index for v in values):
+            self._domain = BitsetDomain(values, universe=current)
+        else:
+            self._domain = BitsetDomain(values, universes=self.csp._universes if self.csp else None)
+
+    @property
+    def neighbors(self):
+        """
+        Get all the variables that share at least one constraint with this variable.
+
+        Returns:
+            A set of this variable's neighbors, not including self.
+        """
+        if self._neighbors is None:
+            self._neighbors = set()
+            for c in self.constraints:
+                self._neighbors |= {v for v in c.variables if v is not self}
+        return self._neighbors
+
+    def ordered_domain(self):
+        """
+        Get this variable's domain as an indexable collection.
+
+        Note that the code implies all values in the domain are consistent
+        with all constraints in the problem.
+
+        Returns:
+            A (sorted) list of this variable's domain.
+        """
+        return self.domain
+
+    def least_constraining_values(self):
+        """
+        Get this variable's domain ordered so that the values that leave the
+        most options to the other variables come first.
+
+        A value's options are the total of its support counts in the
+        constraints that count them (see `BaseConstraint.support_counts`).
+        Values that tie keep their order in the domain.
+
+        Returns:
+            A list of this variable's domain.
+        """
+        values = list(self.domain)
+        options = dict.fromkeys(values, 0)
+        for c in self.constraints:
+            counts = c.support_counts(self)
+            if counts is not None:
+                for value in values:
+                    options[value] += counts.get(value, 0)
+        values.sort(key=options.get, reverse=True)
+        return values
+
+    def find_constraints_between(self, other_var):
+        """
+        Find all the constraints covered by both of two given variables.
+
+        Args:
+            other_var: The other variable we're looking for in each constraint.
+
+        Returns:
+            A list of the shared constraints.
+        """
+        return [c for c in self.constraints if c.covers(other_var)]
+
+    def find_constraint_between(self, other_var):
+        """
+        For a "linear" CSP, return the only constraint that covers two given variables.
+
+        Args:
+            other_var: The other variable we're looking for in each constraint
+
+        Returns:
+            A singleton list of the shared constraint, or an empty list if
+            no shared constraint exists.
+        """
+        for c in self.constraints:
+            if c.covers(other_var):
+                return [c]
+        return list()
+
+    def get_name(self):
+        """
+        A convenience method for sorting variables in a list.
+        """
+        return self.name
+
+    def __repr__(self):
+        return "[Variable] {} => {}".format(
+            self.name, self.value if self.value is not None else self.domain)
+
+
+class BaseConstraint:
+    """
+    A constraint in the CSP.
+
+    Attributes:
+        id (int): A number unique to this constraint, increasing in the order
+            constraints are created
+        variables: A list of variables this constraint covers
+
+    Class attributes:
+        is_global: If True, the constraint prunes all its variables at once
+            through `filter` instead of being revised one variable at a time
+            through `is_satisfiable`.
+        cacheable: If True, `is_satisfiable` depends only on the covered
+            variables' domains, so its answers may be kept in a
+            SupportCache. Set it to False for constraints that look at
+            anything else.
+    """
+    is_global = False
+
+    cacheable = True
+
+    _ids = itertools.count()
+
+    def __init__(self, variables):
+        """
+        Constructor.
+
+        Args:
+            variables: An iterable of variables this constraint covers
+        """
+        self.id = next(BaseConstraint._ids)
+        self.variables = list(variables)
+        for variable in self.variables:
+            variable.constraints.add(self)
+
+    def get_id(self):
+        """
+        A convenience method for sorting constraints in a list.
+        """
+        return self.id
+
+    def is_satisfiable(self, variable, assignment):
+        """
+        Determine if variable.value = assignment is satisfiable with the constraint.
+
+        This is an abstract method that should be implemented by subclasses.
+
+        Arguments:
+            variable: The variable we're assigning to
+            assignment: The value we're assigning to the variable
+        """
+        raise NotImplementedError
+
+    def find_support(self, variable, assignment):
+        """
+        Find a tuple of values that satisfies the constraint with
+        variable.value = assignment.
+
+        Subclasses should override this when they can name the supporting
+        tuple cheaply, so that the 'ac3rm' propagation mode can reuse it. The
+        default just defers to `is_satisfiable`.
+
+        Arguments:
+            variable: The variable we're assigning to
+            assignment: The value we're assigning to the variable
+
+        Returns:
+            A sequence of values, one for each variable in self.variables and
+            in the same order, drawn from the variables' current domains; an
+            empty tuple if the constraint is satisfiable but no supporting
+            tuple is available; or None if the constraint isn't satisfiable.
+        """
+        return tuple() if self.is_satisfiable(variable, assignment) else None
+
+    def is_valid_support(self, support):
+        """
+        Determine if a tuple returned by `find_support` is still a support.
+
+        Args:
+            support: A sequence of values, one for each variable in
+                self.variables
+
+        Returns:
+            True iff every value in support is still in the domain of its
+            variable.
+        """
+        return all(value in var.domain for (var, value) in zip(self.variables, support))
+
+    def support_counts(self, variable):
+        """
+        Count the supports of each value in a variable's domain: the tuples
+        of the other variables' current values that satisfy the constraint
+        with it. Value ordering uses the counts to try the values that leave
+        the most options first.
+
+        Subclasses should override this when they can count supports
+        cheaply. The default can't count them.
+
+        Args:
+            variable: One of the variables this constraint covers
+
+        Returns:
+            A mapping of value -> its number of supports (or a number that
+            grows with it), or None if the constraint doesn't count them.
+        """
+        return None
+
+    def filter(self):
+        """
+        Find the values that can be removed from the covered variables'
+        domains.
+
+        Global constraints must implement this. The result must be a fixed
+        point: filtering again straight away must remove nothing more.
+
+        Returns:
+            A mapping of variable -> mask of the values to remove from its
+            domain. A variable whose values are all removed makes the
+            constraint fail.
+        """
+        raise NotImplementedError
+
+    def covers(self, variable):
+        """
+        Determine if this constraint covers the given variable.
+
+        Args:
+            variable: The variable we're checking against this constraint
+
+        Returns:
+            True iff this constraint covers the given variable.
+        """
+        return variable in self.variables
+
+    def get_variables(self):
+        """
+        Get all the variables this constraint covers.
+
+        Returns:
+            A list of variables this constraint covers.
+        """
+        return self.variables
+
+
+class AllDifferentConstraint(BaseConstraint):
+    """
+    A constraint that is satisfied iff all the variables it covers are assigned
+    different values.
+
+    The constraint is propagated as a whole, to generalized arc consistency
+    (Regin's algorithm): it keeps a maximum matching of variables to values,
+    and removes every value that belongs to no maximum matching. The matching
+    is kept between calls and only repaired where its values have been
+    pruned.
+    """
+    is_global = True
+
+    def __init__(self, variables):
+        BaseConstraint.__init__(self, variables)
+        self._matching = dict()
+
+    def is_satisfiable(self, variable, assignment):
+        if assignment not in variable.domain:
+            return False
+
+        # Some value other than assignment is left in k's domain.
+        return all(k is variable
+                   or (k.domain and (len(k.domain) > 1 or assignment not in k.domain))
+                   for k in self.variables)
+
+    def filter(self):
+        variables = self.variables
+        matching = self._matching
+        owner = dict()
+
+        # Keep the parts of the last matching that are still valid.
+        for var in variables:
+            if var in matching:
+                value = matching[var]
+                if value in var.domain and value not in owner:
+                    owner[value] = var
+                else:
+                    del matching[var]
+
+        for var in variables:
+            if var not in matching and not self._augment(var, matching, owner):
+                return {var: var.domain.bits}
+
+        # Orient the value graph: each variable points to its matched value
+        # and each value to the other variables that could take it.
+        n = len(variables)
+        value_ids = dict()
+        for var in variables:
+            for value in var.domain:
+                if value not in value_ids:
+                    value_ids[value] = n + len(value_ids)
+        graph = [[value_ids[matching[var]]] for var in variables]
+        graph.extend(list() for _ in value_ids)
+        for (i, var) in enumerate(variables):
+            for value in var.domain:
+                if value != matching[var]:
+                    graph[value_ids[value]].append(i)
+
+        # An edge belongs to some maximum matching iff it's matched, lies on
+        # an alternating path from a free value, or lies on an alternating
+        # cycle.
+        reachable = [False] * len(graph)
+        frontier = [value_ids[value] for value in value_ids if value not in owner]
+        for node in frontier:
+            reachable[node] = True
+        while frontier:
+            node = frontier.pop()
+            for succ in graph[node]:
+                if not reachable[succ]:
+                    reachable[succ] = True
+                    frontier.append(succ)
+        component = strongly_connected_components(graph)
+
+        removed = dict()
+        for (i, var) in enumerate(variables):
+            index = var.domain.index
+            mask = 0
+            for value in var.domain:
+                node = value_ids[value]
+                if (value != matching[var] and not reachable[node]
+                        and component[node] != component[i]):
+                    mask |= 1 << index[value]
+            if mask:
+                removed[var] = mask
+        return removed
+
+    @staticmethod
+    def _augment(root, matching, owner):
+        """
+        Extend the matching to root along a shortest augmenting path.
+
+        Returns:
+            True iff root could be matched.
+        """
+        reached_by = dict()
+        visited = {root}
+        queue = deque([root])
+        while queue:
+            var = queue.popleft()
+            for value in var.domain:
+                if value in reached_by:
+                    continue
+                reached_by[value] = var
+                holder = owner.get(value)
+                if holder is None:
+                    # Flip every edge on the path back to root.
+                    while True:
+                        var = reached_by[value]
+                        previous = matching.get(var)
+                        matching[var] = value
+                        owner[value] = var
+                        if var is root:
+                            return True
+                        value = previous
+                if holder not in visited:
+                    visited.add(holder)
+                    queue.append(holder)
+        return False
+
+    def __repr__(self):
+        return "[AllDifferentConstraint]: {}".format(self.variables)
+
+
+class LinearConstraint(BaseConstraint):
+    """
+    A constraint that is satisfied iff sum(c_i * x_i) <relation> constant,
+    where the x_i are the variables it covers and have numeric domains.
+
+    The constraint is propagated as a whole. Bounds reasoning removes every
+    value whose term can't be balanced by the other variables' smallest and
+    largest terms, repeated to a fixed point; for an inequality this is
+    already generalized arc consistency. For an equality, if the partial
+    sums span at most `exact_limit` values, the reachable partial sums are
+    enumerated as well, which removes every value without a support.
+
+    Attributes:
+        coefficients (list): c_i for each variable in self.variables
+        relation (str): One of RELATIONS
+        constant: The right-hand side
+    """
+    is_global = True
+
+    RELATIONS = ('==', '<=', '>=')
+
+    exact_limit = 1 << 10
+
+    def __init__(self, variables, coefficients, relation='==', constant=0):
+        """
+        Constructor.
+
+        The coefficients of a variable that appears more than once are added
+        together, and variables whose coefficients cancel out are dropped.
+
+        Args:
+            variables: An iterable of variables
+            coefficients: An iterable of numbers, one for each variable
+            relation (str): One of RELATIONS
+            constant: The number the weighted sum is compared to
+        """
+        if relation not in self.RELATIONS:
+            raise ValueError("Unknown relation: {}".format(relation))
+
+        merged = dict()
+        for (var, coefficient) in zip(variables, coefficients):
+            merged[var] = merged.get(var, 0) + coefficient
+        merged = {var: c for (var, c) in merged.items() if c != 0}
+
+        BaseConstraint.__init__(self, merged)
+        self.coefficients = [merged[var] for var in self.variables]
+        self.relation = relation
+        self.constant = constant
+
+        # Propagate a >= inequality as the <= inequality with signs flipped.
+        self._sign = -1 if relation == '>=' else 1
+
+    def is_satisfiable(self, variable, assignment):
+        if assignment not in variable.domain:
+            return False
+        terms = self._terms()
+        i = self.variables.index(variable)
+        terms[i] = [(self._sign * self.coefficients[i] * assignment, assignment)]
+        return self._propagate(terms) is None
+
+    def filter(self):
+        terms = self._terms()
+        wiped = self._propagate(terms)
+        if wiped is not None:
+            var = self.variables[wiped]
+            return {var: var.domain.bits}
+
+        removed = dict()
+        for (var, ts) in zip(self.variables, terms):
+            if len(ts) < len(var.domain):
+                domain = var.domain
+                mask = domain.bits & ~domain.mask(value for (_, value) in ts)
+                removed[var] = mask
+        return removed
+
+    def _terms(self):
+        """
+        Get, for each variable, the (term, value) pairs it can contribute,
+        with signs flipped for a >= inequality.
+        """
+        sign = self._sign
+        return [[(sign * c * value, value) for value in var.domain]
+                for (var, c) in zip(self.variables, self.coefficients)]
+
+    def _propagate(self, terms):
+        """
+        Remove the terms without a support, in place, as far as the
+        constraint's reasoning goes.
+
+        Returns:
+            The position of a variable left without terms, or None.
+        """
+        for (i, ts) in enumerate(terms):
+            if not ts:
+                return i
+        wiped = self._narrow(terms)
+        if wiped is None and self.relation == '==':
+            spread = sum(max(ts)[0] - min(ts)[0] for ts in terms)
+            if spread <= self.exact_limit:
+                wiped = self._narrow_exact(terms)
+        return wiped
+
+    def _narrow(self, terms):
+        """
+        Remove the terms that fail bounds reasoning, in place.
+
+        Returns:
+            The position of a variable left without terms, or None.
+        """
+        constant = self._sign * self.constant
+        equality = self.relation == '=='
+        lows = [min(ts)[0] if ts else 0 for ts in terms]
+        highs = [max(ts)[0] if ts else 0 for ts in terms]
+        low = sum(lows)
+        high = sum(highs)
+
+        changed = True
+        while changed:
+            changed = False
+            for (i, ts) in enumerate(terms):
+                upper = constant - (low - lows[i])
+                lower = constant - (high - highs[i]) if equality else lows[i]
+                if lows[i] >= lower and highs[i] <= upper:
+                    continue
+                kept = [(t, v) for (t, v) in ts if lower <= t <= upper]
+                if not kept:
+                    return i
+                terms[i] = kept
+                (new_low, new_high) = (min(kept)[0], max(kept)[0])
+                low += new_low - lows[i]
+                high += new_high - highs[i]
+                (lows[i], highs[i]) = (new_low, new_high)
+                changed = True
+        return None
+
+    def _narrow_exact(self, terms):
+        """
+        Remove the terms of an equality that have no support, in place.
+
+        Returns:
+            The position of a variable left without terms, or None.
+        """
+        forward = [{0}]
+        for ts in terms[:-1]:
+            forward.append({f + t for f in forward[-1] for (t, _) in ts})
+
+        constant = self.constant
+        backward = {0}
+        for i in reversed(range(len(terms))):
+            before = forward[i]
+            kept = [(t, v) for (t, v) in terms[i]
+                    if any(constant - t - b in before for b in backward)]
+            if not kept:
+                return i
+            terms[i] = kept
+            backward = {b + t for b in backward for (t, _) in kept}
+        return None
+
+    def __repr__(self):
+        return "[LinearConstraint]: {} {} {}".format(
+            ' + '.join('{} * {}'.format(c, var.name)
+                       for (c, var) in zip(self.coefficients, self.variables)),
+            self.relation, self.constant)
+
+
+class TableConstraint(BaseConstraint):
+    """
+    A constraint that is satisfied iff the values of the variables it covers
+    form one of the rows of a table of allowed tuples.
+
+    The constraint is propagated as a whole, to generalized arc consistency,
+    with the Compact-Table algorithm. Rows are identified by their position
+    in the table, and a set of rows is an integer with bit i set iff it
+    includes row i. The constraint keeps the set of rows that are still
+    valid, i.e. whose every value is in its variable's domain, as a
+    reversible mask on the CSP's trail. Each time it's filtered, it removes
+    the supports of the values removed since the last time (or keeps the
+    supports of the values left, if that's fewer), and then removes every
+    value whose supports are no longer valid.
+
+    Attributes:
+        table: The allowed tuples, each a sequence of values in the order of
+            self.variables
+        supports (list): A list of dicts, one for each variable: value -> the
+            set of rows with that value in the variable's position
+    """
+    is_global = True
+
+    def __init__(self, variables, table, supports=None):
+        """
+        Constructor.
+
+        Args:
+            variables: An iterable of distinct variables
+            table: A sequence of allowed tuples
+            supports (list): The table's support masks as described above,
+                if they're already known, e.g. to share them between
+                constraints over the same table; by default they're built
+                from the table
+        """
+        BaseConstraint.__init__(self, variables)
+        self.table = table
+        if supports is None:
+            supports = self.build_supports(table, len(self.variables))
+        self.supports = supports
+        self._current = _Mask()
+        self._seen = [_Mask() for var in self.variables]
+        self._domains = [None] * len(self.variables)
+
+    @staticmethod
+    def build_supports(table, arity):
+        """
+        Build the support masks of a table.
+
+        The masks are assembled as byte arrays, since setting bits one at a
+        time in an integer would copy it for every row.
+
+        Args:
+            table: A sequence of tuples of length arity
+            arity (int): The number of columns
+
+        Returns:
+            A list of dicts, one for each column: value -> the set of rows
+            with that value in the column.
+        """
+        nbytes = (len(table) + 7) // 8
+        columns = [dict() for i in range(arity)]
+        for (row, values) in enumerate(table):
+            (byte, bit) = (row >> 3, 1 << (row & 7))
+            for (column, value) in zip(columns, values):
+                array = column.get(value)
+                if array is None:
+                    array = column[value] = bytearray(nbytes)
+                array[byte] |= bit
+        return [{value: int.from_bytes(array, 'little') for (value, array) in column.items()}
+                for column in columns]
+
+    def _rows(self, i, domain):
+        """
+        Get the set of rows whose value at position i is in domain.
+        """
+        masks = self.supports[i]
+        rows = 0
+        for value in domain:
+            rows |= masks.get(value, 0)
+        return rows
+
+    def is_satisfiable(self, variable, assignment):
+        return self.find_support(variable, assignment) is not None
+
+    def find_support(self, variable, assignment):
+        i = self.variables.index(variable)
+        rows = self.supports[i].get(assignment, 0) if assignment in variable.domain else 0
+        for (j, var) in enumerate(self.variables):
+            if not rows:
+                return None
+            if j != i:
+                rows &= self._rows(j, var.domain)
+        if not rows:
+            return None
+        return tuple(self.table[(rows & -rows).bit_length() - 1])
+
+    def support_counts(self, variable):
+        # The valid rows are kept up to date by filtering, unless a domain
+        # has changed since.
+        current = self._current.bits
+        if any(var.domain is not domain or var.domain.bits != mask.bits
+               for (var, domain, mask) in zip(self.variables, self._domains, self._seen)):
+            current = -1
+            for (i, var) in enumerate(self.variables):
+                current &= self._rows(i, var.domain)
+        masks = self.supports[self.variables.index(variable)]
+        return {value: popcount(masks.get(value, 0) & current) for value in variable.domain}
+
+    def filter(self):
+        variables = self.variables
+        supports = self.supports
+        csp = variables[0].csp
+        seen = self._seen
+        current = self._current.bits
+
+        # Domains only shrink between calls unless they were replaced or
+        # restored outside the trail, in which case start over.
+        if any(var.domain is not domain or var.domain.bits & ~mask.bits
+               for (var, domain, mask) in zip(variables, self._domains, seen)):
+            self._domains = [var.domain for var in variables]
+            current = -1
+            for (i, var) in enumerate(variables):
+                current &= self._rows(i, var.domain)
+                csp._set_bits(seen[i], var.domain.bits)
+        else:
+            for (i, var) in enumerate(variables):
+                domain = var.domain
+                delta = seen[i].bits & ~domain.bits
+                if not delta:
+                    continue
+                masks = supports[i]
+                if popcount(delta) < len(domain):
+                    rows = 0
+                    universe = domain.universe
+                    while delta:
+                        low = delta & -delta
+                        rows |= masks.get(universe[low.bit_length() - 1], 0)
+                        delta ^= low
+                    current &= ~rows
+                else:
+                    current &= self._rows(i, domain)
+                csp._set_bits(seen[i], domain.bits)
+                if not current:
+                    break
+
+        if current != self._current.bits:
+            csp._set_bits(self._current, current)
+        if not current:
+            return {variables[0]: variables[0].domain.bits}
+
+        removed = dict()
+        for (i, var) in enumerate(variables):
+            domain = var.domain
+            masks = supports[i]
+            index = domain.index
+            mask = 0
+            for value in domain:
+                if not masks.get(value, 0) & current:
+                    mask |= 1 << index[value]
+            if mask:
+                removed[var] = mask
+                csp._set_bits(seen[i], domain.bits & ~mask)
+        return removed
+
+    def __repr__(self):
+        return "[TableConstraint]: {} ({} rows)".format(
+            [var.name for var in self.variables], len(self.table))
+
+
+class LexLeqConstraint(BaseConstraint):
+    """
+    A constraint that is satisfied iff the values of one sequence of
+    variables, xs, are lexicographically at most those of another, ys, of
+    the same length: at the first position where they differ, the value in
+    xs is the smaller.
+
+    The values at each position are compared by `key`. The constraint is
+    propagated as a whole. Only the first position whose values aren't
+    already fixed and equal can lose values: the value of xs there can't
+    exceed the largest of ys, and must be smaller if the rest of xs can't be
+    at most the rest of ys. When no variable appears twice, this is
+    generalized arc consistency.
+
+    It's the constraint `ConstraintSatisfactionProblem.add_symmetry` uses to
+    break a symmetry.
+
+    Attributes:
+        xs (list): The variables on the left-hand side
+        ys (list): The variables on the right-hand side
+        key: A function of a value to compare it by, or None to compare the
+            values themselves
+    """
+    is_global = True
+
+    def __init__(self, xs, ys, key=None):
+        """
+        Constructor.
+
+        Args:
+            xs: An iterable of variables
+            ys: An iterable of as many variables
+            key: As described above
+
+        Raises:
+            ValueError: xs and ys have different lengths.
+        """
+        xs = list(xs)
+        ys = list(ys)
+        if len(xs) != len(ys):
+            raise ValueError("The sequences must have the same length")
+        BaseConstraint.__init__(self, dict.fromkeys(xs + ys))
+        self.xs = xs
+        self.ys = ys
+        self.key = key
+        self._orders = dict()
+
+    def is_satisfiable(self, variable, assignment):
+        if assignment not in variable.domain:
+            return False
+        return self._propagate({variable: 1 << variable.domain.index[assignment]}) is None
+
+    def filter(self):
+        bits = dict()
+        wiped = self._propagate(bits)
+        if wiped is not None:
+            return {wiped: wiped.domain.bits}
+        return {var: var.domain.bits & ~mask for (var, mask) in bits.items()
+                if mask != var.domain.bits}
+
+    def _order(self, domain):
+        """
+        Get the order of a domain's universe by key, as a tuple: the sorted
+        keys, prefix masks where prefix[n] holds the n values with the
+        smallest keys, the keys by bit position, and whether bit positions
+        are already in key order. It's computed once for each universe.
+        """
+        order = self._orders.get(id(domain.index))
+        if order is None or order[4] is not domain.index:
+            key = self.key
+            keys = [value if key is None else key(value) for value in domain.universe]
+            positions = sorted(range(len(keys)), key=keys.__getitem__)
+            prefix = [0]
+            for i in positions:
+                prefix.append(prefix[-1] | 1 << i)
+            order = ([keys[i] for i in positions], prefix, keys,
+                     positions == list(range(len(keys))), domain.index)
+            self._orders[id(domain.index)] = order
+        return order
+
+    def _low(self, variable, mask):
+        """
+        Get the smallest key of the values in a mask of a variable's domain.
+        """
+        (_, _, keys, ordered, _) = self._order(variable.domain)
+        if ordered:
+            return keys[(mask & -mask).bit_length() - 1]
+        return min(keys[i] for i in _positions(mask))
+
+    def _high(self, variable, mask):
+        """
+        Get the largest key of the values in a mask of a variable's domain.
+        """
+        (_, _, keys, ordered, _) = self._order(variable.domain)
+        if ordered:
+            return keys[mask.bit_length() - 1]
+        return max(keys[i] for i in _positions(mask))
+
+    def _can_be_leq(self, start, bits):
+        """
+        Determine if xs[start:] can be lexicographically at most ys[start:],
+        looking at each position's values on their own.
+        """
+        for (x, y) in zip(self.xs[start:], self.ys[start:]):
+            if x is y:
+                continue
+            low = self._low(x, bits.get(x, x.domain.bits))
+            high = self._high(y, bits.get(y, y.domain.bits))
+            if low != high:
+                return low < high
+        return True
+
+    def _propagate(self, bits):
+        """
+        Remove the values without a support from the masks, in place.
+
+        Args:
+            bits (dict): A mapping of variable -> the mask of its values, for
+                the variables whose masks differ from their domains
+
+        Returns:
+            A variable left without values, or None.
+        """
+        for (i, (x, y)) in enumerate(zip(self.xs, self.ys)):
+            if x is y:
+                continue
+            (x_keys, x_prefix) = self._order(x.domain)[:2]
+            (y_keys, y_prefix) = self._order(y.domain)[:2]
+            while True:
+                (x_bits, y_bits) = (bits.get(x, x.domain.bits), bits.get(y, y.domain.bits))
+                (low, high) = (self._low(x, x_bits), self._high(y, y_bits))
+                if self._can_be_leq(i + 1, bits):
+                    keep_x = x_bits & x_prefix[bisect.bisect_right(x_keys, high)]
+                    keep_y = y_bits & ~y_prefix[bisect.bisect_left(y_keys, low)]
+                else:
+                    keep_x = x_bits & x_prefix[bisect.bisect_left(x_keys, high)]
+                    keep_y = y_bits & ~y_prefix[bisect.bisect_right(y_keys, low)]
+                if not keep_x:
+                    return x
+                if not keep_y:
+                    return y
+                if keep_x == x_bits and keep_y == y_bits:
+                    break
+                bits[x] = keep_x
+                bits[y] = keep_y
+
+            # Go on to the next position only if this one must be equal.
+            if not low == self._high(x, x_bits) == self._low(y, y_bits) == high:
+                return None
+        return None
+
+    def __repr__(self):
+        return "[LexLeqConstraint]: {} <= {}".format(
+            [var.name for var in self.xs], [var.name for var in self.ys])
+
+
+def _positions(mask):
+    """
+    Iterate over the positions of the bits set in a mask.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class ValuePrecedenceConstraint(BaseConstraint):
+    """
+    A constraint that is satisfied iff each of a sequence of interchangeable
+    values is taken by a variable only if the value before it is taken by an
+    earlier variable, in the order of self.variables.
+
+    Of every set of solutions that differ only by a permutation of the
+    values, this keeps the one where the values are first used in order.
+    The constraint is propagated as a whole: the variables are visited in
+    order, counting the values that may have been used so far, and each
+    variable loses the values that would skip one. This is weaker than
+    generalized arc consistency, but exact once the variables are assigned.
+
+    It's the constraint `ConstraintSatisfactionProblem.add_value_symmetry`
+    uses to break a value symmetry.
+
+    Attributes:
+        values (list): The interchangeable values, in the order they must
+            first be used
+    """
+    is_global = True
+
+    def __init__(self, variables, values):
+        """
+        Constructor.
+
+        Args:
+            variables: An iterable of distinct variables
+            values: An iterable of values
+        """
+        BaseConstraint.__init__(self, variables)
+        self.values = list(values)
+
+    def is_satisfiable(self, variable, assignment):
+        if assignment not in variable.domain:
+            return False
+        bits = {var: var.domain.bits for var in self.variables}
+        bits[variable] = 1 << variable.domain.index[assignment]
+        return self._propagate(bits) is None
+
+    def filter(self):
+        bits = {var: var.domain.bits for var in self.variables}
+        wiped = self._propagate(bits)
+        if wiped is not None:
+            return {wiped: wiped.domain.bits}
+        return {var: var.domain.bits & ~mask for (var, mask) in bits.items()
+                if mask != var.domain.bits}
+
+    def _propagate(self, bits):
+        """
+        Remove the values that would be used out of order from the masks,
+        in place.
+
+        Args:
+            bits (dict): A mapping of variable -> the mask of its values
+
+        Returns:
+            A variable left without values, or None.
+        """
+        values = self.values
+        used = 0
+        for var in self.variables:
+            # Once every value may have been used, nothing is out of order.
+            if used >= len(values) - 1:
+                break
+            index = var.domain.index
+            late = 0
+            for value in values[used + 1:]:
+                i = index.get(value)
+                if i is not None:
+                    late |= 1 << i
+            bits[var] &= ~late
+            if not bits[var]:
+                return var
+            i = index.get(values[used])
+            if i is not None and (bits[var] >> i) & 1:
+                used += 1
+        return None
+
+    def __repr__(self):
+        return "[ValuePrecedenceConstraint]: {} over {}".format(
+            self.values, [var.name for var in self.variables])
+
+
+class CompiledProblem:
+    """
+    A problem compiled to flat integer arrays.
+
+    Variables and constraints are numbered by their position in the
+    problem's `variables` and in creation order. Lists of lists are stored
+    CSR-style, as an offsets array and a flat array, where the items of row
+    i are flat[offsets[i]:offsets[i + 1]]. Values are numbered by their
+    position in their variable's universe.
+
+    The compiled form can be written to a compact binary file and memory
+    mapped back, so loading it costs almost nothing, and processes loading
+    the same file share its pages. `to_csp` builds a problem to search from
+    it, with the solver's indexes taken from the arrays.
+
+    Table, all-different and linear constraints are compiled to arrays;
+    table subclasses, such as the word square's, compile to plain tables.
+    Constraints over the same table object and the same universes store
+    the table and its support masks once, and come back sharing them; the
+    rows are decoded as they're read. Other constraints are pickled, with their variables replaced by
+    their numbers. Variables come back as BaseVariables.
+
+    The metadata and the pickled constraints are unpickled on loading, which
+    can run arbitrary code, so only load compiled files you trust.
+
+    Attributes:
+        names (list): The variables' names
+        aux (list): The variables' aux flags
+        values (list): Every distinct domain value, in first-seen order
+        universe_offsets, universe: For each variable, its universe, as
+            indices into values
+        domain_offsets, domain: For each variable, the positions in its
+            universe of its domain's values
+        kinds (list): Each constraint's kind: 'table', 'alldiff', 'linear' or
+            'pickle'
+        scope_offsets, scope: For each constraint, its variables
+        constraint_offsets, constraints: For each variable, the constraints
+            covering it
+        neighbor_offsets, neighbors: For each variable, its neighbors
+        table_numbers: For each constraint, the number of its table; 0
+            unless it's a table
+        table_offsets, rows: For each distinct table, its flattened rows, as
+            positions in the universes
+        support_offsets, supports: For each distinct table, its support
+            masks as little-endian bitsets of its rows, one for each column
+            and position in the column's universe, in that order
+        payloads (dict): Constraint number -> the constraint's other data:
+            (coefficients, relation, constant) for a linear constraint, the
+            pickle of any other non-table constraint
+        disjoint (bool): The problem's is_disjoint_constraints
+    """
+
+    magic = b'CSPC0002'
+
+    # magic, metadata length
+    header = struct.Struct('<8sQ')
+
+    arrays = ('universe_offsets', 'universe', 'domain_offsets', 'domain',
+              'scope_offsets', 'scope', 'constraint_offsets', 'constraints',
+              'neighbor_offsets', 'neighbors', 'table_numbers', 'table_offsets', 'rows',
+              'support_offsets', 'supports')
+
+    @classmethod
+    def from_csp(cls, csp):
+        """
+        Compile a problem.
+
+        Args:
+            csp (ConstraintSatisfactionProblem): The problem, with no
+                assumptions in place
+
+        Returns:
+            A CompiledProblem.
+        """
+        csp._ensure_frozen()
+        variables = list(csp.variables.values())
+        number = csp._order
+        constraints = sorted(csp.constraints, key=BaseConstraint.get_id)
+        numbers = {c: i for (i, c) in enumerate(constraints)}
+
+        self = cls.__new__(cls)
+        self.names = list(csp.variables)
+        self.aux = [var.aux for var in variables]
+        self.disjoint = csp.is_disjoint_constraints
+
+        pool = dict()
+        (self.universe_offsets, self.universe) = _csr(
+            [pool.setdefault(value, len(pool)) for value in var.domain.universe] for var in variables)
+        self.values = list(pool)
+        (self.domain_offsets, self.domain) = _csr(
+            [var.domain.index[value] for value in var.domain] for var in variables)
+
+        (self.scope_offsets, self.scope) = _csr(
+            [number[var] for var in c.variables] for c in constraints)
+        (self.constraint_offsets, self.constraints) = _csr(
+            sorted(numbers[c] for c in var.constraints if c in numbers) for var in variables)
+        (self.neighbor_offsets, self.neighbors) = _csr(
+            sorted(number[n] for n in csp.arc_index[var]) for var in variables)
+
+        self.kinds = list()
+        self.payloads = dict()
+        table_numbers = list()
+        tables = list()
+        masks = list()
+        shared = dict()
+        for (i, c) in enumerate(constraints):
+            table_numbers.append(0)
+            if isinstance(c, TableConstraint):
+                self.kinds.append('table')
+                indexes = [var.domain.index for var in c.variables]
+                key = (id(c.table),) + tuple(id(index) for index in indexes)
+                if key not in shared:
+                    shared[key] = len(tables)
+                    table = list()
+                    for row in c.table:
+                        # A row with a value outside its variable's universe
+                        # can never be valid, so it's left out.
+                        if all(value in index for (index, value) in zip(indexes, row)):
+                            table.extend(index[value] for (index, value) in zip(indexes, row))
+                    tables.append(table)
+                    arity = len(indexes)
+                    nbytes = (len(table) // arity + 7) // 8 if arity else 0
+                    columns = TableConstraint.build_supports(
+                        [table[r:r + arity] for r in range(0, len(table), arity)], arity)
+                    masks.append(b''.join(column.get(p, 0).to_bytes(nbytes, 'little')
+                                          for (column, index) in zip(columns, indexes)
+                                          for p in range(len(index))))
+                table_numbers[i] = shared[key]
+            elif type(c) is AllDifferentConstraint:
+                self.kinds.append('alldiff')
+            elif type(c) is LinearConstraint:
+                self.kinds.append('linear')
+                self.payloads[i] = (c.coefficients, c.relation, c.constant)
+            else:
+                self.kinds.append('pickle')
+                buffer = io.BytesIO()
+                _VariablePickler(buffer, number).dump(c)
+                self.payloads[i] = buffer.getvalue()
+        (_, self.table_numbers) = _csr([table_numbers])
+        (self.table_offsets, self.rows) = _csr(tables)
+        (self.support_offsets, self.supports) = _csr(masks)
+        return self
+
+    def to_bytes(self):
+        """
+        Serialize the compiled problem.
+
+        The file holds the header, the metadata (names, values, kinds and
+        payloads) pickled, and then each of the arrays, aligned to 8 bytes.
+        """
+        blobs = [getattr(self, name) for name in self.arrays]
+        layout = list()
+        offset = 0
+        for blob in blobs:
+            layout.append((blob.typecode, offset, len(blob)))
+            offset += -(-len(blob) * blob.itemsize // 8) * 8
+        meta = pickle.dumps((self.names, self.aux, self.values, self.kinds, self.payloads,
+                             self.disjoint, layout), pickle.HIGHEST_PROTOCOL)
+        meta += bytes(-len(meta) % 8)
+
+        out = io.BytesIO()
+        out.write(self.header.pack(self.magic, len(meta)))
+        out.write(meta)
+        for blob in blobs:
+            data = blob.tobytes()
+            out.write(data + bytes(-len(data) % 8))
+        return out.getvalue()
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        """
+        Load a compiled problem from bytes written by `to_bytes`, or any
+        buffer holding them, such as a memory map. The arrays are views of
+        the buffer, not copies. The buffer's metadata is unpickled, so it
+        must come from a trusted source.
+
+        Raises:
+            ValueError: The buffer doesn't hold a compiled problem.
+        """
+        view = memoryview(buffer)
+        try:
+            (magic, size) = cls.header.unpack_from(view)
+        except struct.error:
+            raise ValueError("Not a compiled problem")
+        if magic != cls.magic:
+            raise ValueError("Not a compiled problem")
+        start = cls.header.size
+        (names, aux, values, kinds, payloads, disjoint, layout) = pickle.loads(view[start:start + size])
+        start += size
+
+        self = cls.__new__(cls)
+        (self.names, self.aux, self.values, self.kinds, self.payloads, self.disjoint) = \
+            (names, aux, values, kinds, payloads, disjoint)
+        for (name, (typecode, offset, length)) in zip(self.arrays, layout):
+            itemsize = array.array(typecode).itemsize
+            data = view[start + offset:start + offset + length * itemsize]
+            setattr(self, name, data.cast(typecode))
+        return self
+
+    def save(self, path):
+        """
+        Write the compiled problem to a file.
+        """
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map a compiled problem written by `save`. As with
+        `from_bytes`, the file must be trusted.
+        """
+        with open(path, 'rb') as f:
+            return cls.from_bytes(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def to_csp(self):
+        """
+        Build a problem to search from the compiled form.
+
+        The problem comes back frozen, with its indexes read from the
+        adjacency arrays.
+
+        Returns:
+            A ConstraintSatisfactionProblem.
+        """
+        csp = ConstraintSatisfactionProblem()
+        csp.is_disjoint_constraints = self.disjoint
+        values = self.values
+        variables = list()
+        for (i, name) in enumerate(self.names):
+            var = BaseVariable(csp, name, self.aux[i])
+            universe = [values[v] for v in _row(self.universe_offsets, self.universe, i)]
+            domain = BitsetDomain(universe, universes=csp._universes)
+            domain.bits = 0
+            for position in _row(self.domain_offsets, self.domain, i):
+                domain.bits |= 1 << position
+            var.domain = domain
+            csp.variables[name] = var
+            variables.append(var)
+
+        constraints = list()
+        tables = dict()
+        for (i, kind) in enumerate(self.kinds):
+            scope = [variables[v] for v in _row(self.scope_offsets, self.scope, i)]
+            if kind == 'table':
+                number = self.table_numbers[i]
+                if number not in tables:
+                    universes = [var.domain.universe for var in scope]
+                    table = _CompiledTable(universes, _row(self.table_offsets, self.rows, number))
+                    masks = _row(self.support_offsets, self.supports, number)
+                    nbytes = (len(table) + 7) // 8
+                    supports = list()
+                    start = 0
+                    for universe in universes:
+                        column = dict()
+                        for value in universe:
+                            bits = int.from_bytes(masks[start:start + nbytes], 'little')
+                            start += nbytes
+                            if bits:
+                                column[value] = bits
+                        supports.append(column)
+                    tables[number] = (table, supports)
+                (table, supports) = tables[number]
+                c = TableConstraint(scope, table, supports)
+            elif kind == 'alldiff':
+                c = AllDifferentConstraint(scope)
+            elif kind == 'linear':
+                (coefficients, relation, constant) = self.payloads[i]
+                c = LinearConstraint(scope, coefficients, relation, constant)
+            else:
+                c = _VariableUnpickler(io.BytesIO(self.payloads[i]), variables).load()
+                for var in c.variables:
+                    var.constraints.add(c)
+            constraints.append(c)
+        csp.constraints = set(constraints)
+
+        csp._order = {var: i for (i, var) in enumerate(variables)}
+        csp._culprits = {var: _Mask() for var in variables}
+        csp.arc_index = dict()
+        csp._arcs = dict()
+        csp._constraint_order = dict()
+        for (i, var) in enumerate(variables):
+            covering = [constraints[c] for c in _row(self.constraint_offsets, self.constraints, i)]
+            neighbors = [variables[n] for n in _row(self.neighbor_offsets, self.neighbors, i)]
+            var._neighbors = set(neighbors)
+            csp._constraint_order[var] = covering
+            csp.arc_index[var] = {n: [c for c in covering if n in c.variables] for n in neighbors}
+        csp._constraint_order[None] = constraints
+        csp._frozen_constraints = set(constraints)
+        csp._frozen_variables = variables
+        csp._root_consistent = False
+        return csp
+
+
+class _CompiledTable(Sequence):
+    """
+    The rows of a compiled table, decoded from positions in the universes
+    as they're read.
+    """
+
+    def __init__(self, universes, flat):
+        """
+        Constructor.
+
+        Args:
+            universes (list): Each column's universe
+            flat: The rows, flattened, as positions in the universes
+        """
+        self.universes = universes
+        self.flat = flat
+        self.arity = len(universes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start = i * self.arity
+        return tuple(universe[p] for (universe, p) in
+                     zip(self.universes, self.flat[start:start + self.arity]))
+
+    def __len__(self):
+        return len(self.flat) // self.arity if self.arity else 0
+
+    def __reduce__(self):
+        # The rows may be a view of a memory map, which can't be pickled.
+        return (list, (list(self),))
+
+
+def _csr(rows):
+    """
+    Flatten a list of lists of non-negative integers to CSR arrays.
+
+    Returns:
+        An (offsets, flat) pair of arrays.
+    """
+    offsets = array.array('q', [0])
+    flat = array.array('q')
+    for row in rows:
+        flat.extend(row)
+        offsets.append(len(flat))
+    typecode = 'B' if max(flat, default=0) < 1 << 8 else 'I' if max(flat) < 1 << 32 else 'q'
+    return (offsets, array.array(typecode, flat))
+
+
+def _row(offsets, flat, i):
+    """
+    Get row i of CSR arrays.
+    """
+    return flat[offsets[i]:offsets[i + 1]]
+
+
+class _VariablePickler(pickle.Pickler):
+    """
+    A pickler that writes variables as their numbers.
+    """
+    def __init__(self, file, numbers):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.numbers = numbers
+
+    def persistent_id(self, obj):
+        if isinstance(obj, BaseVariable):
+            return self.numbers[obj]
+        return None
+
+
+class _VariableUnpickler(pickle.Unpickler):
+    """
+    An unpickler that reads variable numbers back as variables.
+    """
+    def __init__(self, file, variables):
+        pickle.Unpickler.__init__(self, file)
+        self.variables = variables
+
+    def persistent_load(self, pid):
+        return self.variables[pid]
+
+
+def strongly_connected_components(graph):
+    """
+    Label the strongly connected components of a directed graph (Tarjan's
+    algorithm, without recursion).
+
+    Args:
+        graph: A list where graph[i] lists the successors of node i
+
+    Returns:
+        A list of component labels, one for each node.
+    """
+    index = [None] * len(graph)
+    lowlink = [0] * len(graph)
+    component = [None] * len(graph)
+    on_stack = [False] * len(graph)
+    stack = list()
+    counter = 0
+    labels = 0
+
+    for start in range(len(graph)):
+        if index[start] is not None:
+            continue
+        work = [(start, 0)]
+        while work:
+            (node, i) = work.pop()
+            if i == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            recurse = False
+            successors = graph[node]
+            while i < len(successors):
+                succ = successors[i]
+                i += 1
+                if index[succ] is None:
+                    work.append((node, i))
+                    work.append((succ, 0))
+                    recurse = True
+                    break
+                if on_stack[succ]:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            if recurse:
+                continue
+
+            if lowlink[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component[member] = labels
+                    if member == node:
+                        break
+                labels += 1
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+    return component
@@ -4,24 +4,39 @@ This module solves (certain types of) cryptarithmetic problems.
 
 from csp import *
 
-import itertools
+import json
+import multiprocessing
 import re
+import sys
+import time
 
 
 class Cryptarithmetic(ConstraintSatisfactionProblem):
     """
     The cryptarithmetic solver.
 
-    This one only solves decimal domain puzzles, and only puzzles with two
-    addends and a sum.
+    This one solves addition puzzles with any number of addends, in any base
+    from 2 to 36.
+
+    The puzzle is modeled column by column. Each column is a
+    LinearConstraint: the carry in plus the addends' letters equals the sum's
+    letter plus base times the carry out. The carries are auxiliary
+    variables.
     """
-    def __init__(self, puzzle):
+
+    digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    pattern = re.compile(r'^\s*([a-zA-Z]+(?:\s*\+\s*[a-zA-Z]+)+)\s*=\s*([a-zA-Z]+)\s*$')
+    plus = re.compile(r'\s*\+\s*')
+
+    def __init__(self, puzzle, base=10):
         """
         Constructor.
 
         Args:
-            puzzle (str): a cryptarithmetic with two addends and a sum, on one
-                line
+            puzzle (str): a cryptarithmetic of the form
+                "addend + addend + ... = sum", on one line
+            base (int): the base the puzzle's numbers are written in
 
         Raises:
             InvalidPuzzleException: The puzzle is invalid.
@@ -29,50 +44,58 @@ class Cryptarithmetic(ConstraintSatisfactionProblem):
         ConstraintSatisfactionProblem.__init__(self)
 
         # Extract the words from the puzzle.
-        self.puzzle = puzzle
-        match = re.match('(\w+)\s*\+\s*(\w+)\s*=\s*(\w+)', puzzle)
-        if match:
-            (addend1, addend2, the_sum) = match.groups()
-        else:
+        match = self.pattern.match(puzzle)
+        if not match or not 2 <= base <= len(self.digits):
             raise InvalidPuzzleException()
+        addends = self.plus.split(match.group(1))
+        the_sum = match.group(2)
+        self.base = base
+        self.addends = addends
+        self.the_sum = the_sum
 
-        m = max(len(the_sum), len(addend2) + 2)
-        self.puzzle = ''.join([addend1.rjust(m), "\n", ("+ " + addend2).rjust(m),
-                "\n", '-' * m, "\n", the_sum.rjust(m)])
+        m = max([len(the_sum), len(addends[-1]) + 2] + [len(a) for a in addends[:-1]])
+        self.puzzle = ''.join([a.rjust(m) + "\n" for a in addends[:-1]] +
+                              [("+ " + addends[-1]).rjust(m), "\n", '-' * m, "\n", the_sum.rjust(m)])
 
         # Create a map: letter -> variable. Then create auxiliary
-        # variables and add them to the map.
-        self.variables = {char: CryptarithmeticVariable(self, char)
+        # variables for the carries and add them to the map. With n addends,
+        # a column's total is at most n * (base - 1) + (n - 1), so its carry
+        # out is at most n - 1.
+        self.variables = {char: CryptarithmeticVariable(self, char, range(base))
                           for char in puzzle if str.isalpha(char)}
-        if len(self.variables) > 10:
+        if len(self.variables) > base:
             raise InvalidPuzzleException()
-        for i in (addend1, addend2, the_sum):
-            self.variables[i[0]].domain.discard(0)
-        for i in range(1, len(the_sum)):
+        for word in addends + [the_sum]:
+            if len(word) > 1:
+                self.variables[word[0]].domain.discard(0)
+
+        columns = max(len(word) for word in addends + [the_sum])
+        for i in range(1, columns):
             name = 'aux' + str(i)
-            self.variables[name] = CryptarithmeticVariable(self, name, aux=True)
+            self.variables[name] = CryptarithmeticVariable(self, name, range(len(addends)), aux=True)
 
         # Create the constraints.
-        for i in range(1, len(the_sum) + 1):
-            left = list()
-            if 'aux' + str(i - 1) in self.variables:
-                left.append(self.variables['aux' + str(i - 1)])
-            if i <= len(addend1):
-                left.append(self.variables[addend1[-i]])
-            if i <= len(addend2):
-                left.append(self.variables[addend2[-i]])
-            right = [self.variables[the_sum[-i]]]
-            if 'aux' + str(i) in self.variables:
-                right.append(self.variables['aux' + str(i)])
-            self.constraints.add(SumConstraint(left, right))
+        for i in range(columns):
+            terms = list()
+            if i > 0:
+                terms.append((self.variables['aux' + str(i)], 1))
+            for addend in addends:
+                if i < len(addend):
+                    terms.append((self.variables[addend[-1 - i]], 1))
+            if i < len(the_sum):
+                terms.append((self.variables[the_sum[-1 - i]], -1))
+            if i + 1 < columns:
+                terms.append((self.variables['aux' + str(i + 1)], -base))
+            self.constraints.add(LinearConstraint([var for (var, _) in terms],
+                                                  [c for (_, c) in terms]))
 
         self.constraints.add(AllDifferentConstraint(
                 [var for var in self.variables.values() if not var.aux]))
 
     def __str__(self):
-        p = self.puzzle[:]
-        for letter in self.variables:
-            p = p.replace(letter, str(self.variables[letter].value))
+        p = ''.join(self.digits[self.variables[c].value]
+                    if c in self.variables and self.variables[c].value is not None else c
+                    for c in self.puzzle)
         return self.puzzle + "\n\n" + p
 
 
@@ -81,73 +104,107 @@ class InvalidPuzzleException(Exception):
 
 
 class CryptarithmeticVariable(BaseVariable):
-    def __init__(self, csp, name, aux=False):
+    __slots__ = ()
+
+    def __init__(self, csp, name, domain, aux=False):
         BaseVariable.__init__(self, csp, name, aux)
-        self.domain = set(range(10)) if not self.aux else set(range(2))
+        self.domain = domain
 
 
-class SumConstraint(BaseConstraint):
-    """
-    A constraint of the form aux_n + A + B = C + 10 ** (aux_n+1)
-    """
-    def __init__(self, left_vars, right_vars):
-        """
-        Constructor.
-
-        Args:
-            left_vars (list of Variable): the variables on the left side
-            of the constraint equation
-            right_vars (list of Variable): the variable on the right side
-            of the constraint equation
-        """
-        BaseConstraint.__init__(self, left_vars + right_vars)
-        self.left_vars = left_vars
-        self.right_vars = right_vars
-
-    def is_satisfiable(self, variable, assignment):
-        result = False
-        old_domain = variable.domain
-        variable.domain = {assignment}
-
-        all_assignments = itertools.product(
-            itertools.product(*(var.domain for var in self.left_vars)),
-            itertools.product(*(var.domain for var in self.right_vars)))
-        try:
-            for combination in all_assignments:
-                left_sum = sum(x for x in combination[0])
-                right_sum = 0
-                for i in range(len(combination[1])):
-                    right_sum += combination[1][i] * (10 ** self.right_vars[i].aux)
-
-                if left_sum == right_sum:
-                    raise SumConstraint.FoundException
-        except SumConstraint.FoundException:
-            result = True
-        finally:
-            variable.domain = old_domain
-
-        return result
-
-    class FoundException(Exception): pass
-
-    def __repr__(self):
-        return ' '.join["[Constraint",
-                        ' + '.join(var.name for var in self.left_vars), "=",
-                        self.right_vars[0].name, '+ 10 *',
-                        self.right_vars[1].name
-                            if len(self.right_vars) == 2 else '']
-
-
-def main(puzzle):
-    c = Cryptarithmetic(puzzle)
+def main(puzzle, base=10):
+    c = Cryptarithmetic(puzzle, base)
     if c.solve():
         print(c)
     else:
         print("No solution.")
 
+
+# The base every puzzle in a batch is solved in, set in each worker process
+# by _init_worker.
+_batch_base = 10
+
+
+def _init_worker(base):
+    global _batch_base
+    _batch_base = base
+
+
+def solve_puzzle(job):
+    """
+    Solve one puzzle of a batch.
+
+    Args:
+        job (tuple): (line, puzzle), the puzzle's line number in the batch
+            and its text
+
+    Returns:
+        A dict with the line, the puzzle, the solution as a map:
+        letter -> digit (None if there is none), the search's node count and
+        the time taken in seconds, including building the model. An invalid
+        puzzle gets an error message instead of a solution.
+    """
+    (line, puzzle) = job
+    result = {'line': line, 'puzzle': puzzle}
+    start = time.perf_counter()
+    try:
+        c = Cryptarithmetic(puzzle, _batch_base)
+    except InvalidPuzzleException:
+        result['error'] = 'invalid puzzle'
+    else:
+        search = Search(c)
+        solved = search.run()
+        result['solution'] = ({name: var.value for (name, var) in sorted(c.variables.items())
+                               if not var.aux} if solved else None)
+        result['nodes'] = search.nodes
+        search.close()
+    result['time'] = time.perf_counter() - start
+    return result
+
+
+def solve_batch(lines, out, workers=None, base=10):
+    """
+    Solve a stream of puzzles over a pool of worker processes, writing one
+    JSON object per puzzle to out as soon as it's solved.
+
+    The workers live for the whole batch, so each one imports the solver
+    and compiles the puzzle grammar once. Puzzles are handed out one at a
+    time, so a slow puzzle doesn't hold up the ones behind it, and results
+    come back in completion order; each carries its line number.
+
+    Args:
+        lines: An iterable of puzzles, one on a line; blank lines and lines
+            starting with '#' are skipped
+        out: A text file to write the results to
+        workers (int): The number of processes, by default one per CPU
+        base (int): The base every puzzle is written in
+
+    Returns:
+        The number of puzzles solved.
+    """
+    jobs = ((i, line.strip()) for (i, line) in enumerate(lines, 1)
+            if line.strip() and not line.lstrip().startswith('#'))
+    solved = 0
+    with multiprocessing.Pool(workers, _init_worker, (base,)) as pool:
+        for result in pool.imap_unordered(solve_puzzle, jobs):
+            solved += result.get('solution') is not None
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    return solved
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("puzzle", help="Enter the cryptarithmetic in double quotes, on one line")
+    parser.add_argument("puzzle", nargs='?', help="Enter the cryptarithmetic in double quotes, on one line")
+    parser.add_argument("--base", type=int, default=10, help="The base of the puzzle's numbers")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Solve every puzzle in FILE ('-' for stdin), printing JSON lines")
+    parser.add_argument("--workers", type=int, help="The number of processes for --batch")
     args = parser.parse_args()
-    main(args.puzzle)
+    if args.batch:
+        with (open(args.batch) if args.batch != '-' else sys.stdin) as f:
+            solve_batch(f, sys.stdout, args.workers, args.base)
+    elif args.puzzle:
+        main(args.puzzle, args.base)
+    else:
+        parser.error("give a puzzle or --batch FILE")
@@ -1,32 +1,100 @@
 from csp import *
 
-from collections import Counter
+from collections.abc import Sequence
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
 
 
 class WordSquare:
     """
     Find a word square of the given size from the given dictionary.
+
+    The dictionary is indexed once per word length. Each index is saved in
+    `cache_dir` and memory-mapped the next time it's needed, until the
+    dictionary file changes. Every CSP made from this object shares the same
+    indexes.
     """
 
     alphabet = list('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
 
-    def __init__(self, wordsfile):
+    def __init__(self, wordsfile, cache_dir=None):
         """
         Constructor.
 
         Arguments:
         wordsfile -- the path to a text file of valid words for this
             word square, with one word on a line
+        cache_dir -- the directory for the compiled indexes, by default
+            `.wordsquare-cache` next to wordsfile; None disables the cache
+            if the directory can't be created
+        """
+        self.wordsfile = wordsfile
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(wordsfile)),
+                                                   '.wordsquare-cache')
+        self._words = None
+        self._digest = None
+        self._indexes = dict()
+
+    @property
+    def words(self):
+        """
+        All the words in the dictionary, upper-cased.
+        """
+        if self._words is None:
+            with open(self.wordsfile) as f:
+                self._words = [str.upper(w.rstrip()) for w in f if str.isalpha(w.rstrip())]
+        return self._words
+
+    @property
+    def digest(self):
+        """
+        The SHA-256 digest of the dictionary file.
         """
-        self.words = (str.upper(w.rstrip()) for w in open(wordsfile) if str.isalpha(w.rstrip()))
+        if self._digest is None:
+            with open(self.wordsfile, 'rb') as f:
+                self._digest = hashlib.sha256(f.read()).digest()
+        return self._digest
 
-    def csp(self, size, diag=False):
-        return WordSquareCSP(self, size, diag)
+    def index(self, size):
+        """
+        Get the WordIndex of the dictionary's words of the given length.
+
+        The index is loaded from the cache if it was compiled from the
+        dictionary's current contents, and otherwise built and saved.
+        """
+        if size in self._indexes:
+            return self._indexes[size]
+
+        path = os.path.join(self.cache_dir, '{}.{}.idx'.format(os.path.basename(self.wordsfile), size))
+        index = WordIndex.load(path, self.digest, self.alphabet)
+        if index is None:
+            index = WordIndex((word for word in self.words if len(word) == size),
+                              size, self.alphabet)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                index.save(path, self.digest)
+            except OSError:
+                pass
+        self._indexes[size] = index
+        return index
+
+    def csp(self, size, diag=False, symmetry=True):
+        return WordSquareCSP(self, size, diag, symmetry)
 
 
 class WordSquareCSP(ConstraintSatisfactionProblem):
+    """
+    The word square CSP.
+
+    A square's transpose is a square too, with the same diagonal, so by
+    default only the one of each pair whose first row comes first
+    alphabetically (reading the rows in turn, if they tie) is searched for.
+    """
 
-    def __init__(self, wordsquare, size, diag):
+    def __init__(self, wordsquare, size, diag, symmetry=True):
         """
         Constructor.
 
@@ -35,32 +103,27 @@ class WordSquareCSP(ConstraintSatisfactionProblem):
         size -- the length of the words in the square
         diag -- True if the CSP has a diagonal constraint, otherwise
             False
+        symmetry -- True to break the transpose symmetry, False to find
+            both a square and its transpose
         """
         ConstraintSatisfactionProblem.__init__(self)
         self.is_disjoint_constraints = True
         self.size = size
 
-        self.letters_count = Counter()
-
-        # create a map: indexOf -> map(letter -> wordlist)
-        lettermap = [{letter: set() for letter in wordsquare.alphabet} for i in range(size)]
-        # filter out words whose length != size
-        for word in (word for word in wordsquare.words if len(word) == size):
-            for index in range(len(word)):
-                lettermap[index][word[index]].add(word)
-                self.letters_count.update(word[index])
+        self.index = wordsquare.index(size)
 
         # create a variable for each (row,col) pair in the word square
         self.variables = {(i, j): WordSquareVariable(self, (i, j)) for i in range(size) for j in range(size)}
 
         # create a constraint for each row and for each col (and the diagonal if requested)
         self.constraints = set()
-        WordSquareConstraint.lettermap = lettermap
         for i in range(size):
-            self.constraints.add(WordSquareConstraint({self.variables[(i, col)] for col in range(size)}))
-            self.constraints.add(WordSquareConstraint({self.variables[(row, i)] for row in range(size)}))
+            self.constraints.add(WordSquareConstraint({self.variables[(i, col)] for col in range(size)}, self.index))
+            self.constraints.add(WordSquareConstraint({self.variables[(row, i)] for row in range(size)}, self.index))
         if diag:
-            self.constraints.add(WordSquareConstraint({self.variables[(i, i)] for i in range(size)}))
+            self.constraints.add(WordSquareConstraint({self.variables[(i, i)] for i in range(size)}, self.index))
+        if symmetry:
+            self.add_symmetry({(i, j): (j, i) for (i, j) in self.variables})
 
     def __str__(self):
         L = list(' ' * (self.size * self.size))
@@ -73,6 +136,151 @@ class WordSquareCSP(ConstraintSatisfactionProblem):
         return ''.join(M)
 
 
+class WordIndex:
+    """
+    The words of one length, indexed by letter and position. The postings
+    are the support masks of every WordSquareConstraint over the index.
+
+    Words are identified by their position in `words`, and a set of words is
+    an integer with bit i set iff it includes words[i].
+
+    Public instance variables:
+    size -- the length of the words
+    words -- the indexed words
+    postings -- a list: string index i -> map: letter -> the set of words
+        whose i-th character is letter
+    """
+
+    # magic, source digest, word length, word count, alphabet length
+    header = struct.Struct('<8s32sIII')
+    magic = b'WSQIDX02'
+
+    def __init__(self, words, size, alphabet):
+        """
+        Constructor.
+
+        Arguments:
+        words -- an iterable of words of length `size`
+        size -- the length of the words
+        alphabet -- the letters the words are made of
+        """
+        self.size = size
+        self.alphabet = list(alphabet)
+        self.words = list(words)
+        self.postings = [{letter: 0 for letter in alphabet} for i in range(size)]
+        for (word_id, word) in enumerate(self.words):
+            bit = 1 << word_id
+            for index in range(size):
+                self.postings[index][word[index]] |= bit
+
+    def save(self, path, digest):
+        """
+        Write the index to path, replacing any file that's there.
+
+        The file holds the header, the alphabet, the words as a matrix of
+        bytes, one row per word, and the postings as little-endian bitsets in
+        (index, letter) order.
+
+        Arguments:
+        path -- the file to write
+        digest -- the digest of the dictionary the index was built from
+        """
+        count = len(self.words)
+        nbytes = (count + 7) // 8
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.header.pack(self.magic, digest, self.size, count, len(self.alphabet)))
+                f.write(''.join(self.alphabet).encode('ascii'))
+                f.write(''.join(self.words).encode('ascii'))
+                for postings in self.postings:
+                    for letter in self.alphabet:
+                        f.write(postings[letter].to_bytes(nbytes, 'little'))
+            # mkstemp makes the file private, but the cache may be shared.
+            os.chmod(temp, 0o644)
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    @classmethod
+    def load(cls, path, digest, alphabet):
+        """
+        Memory-map an index written by `save`.
+
+        Arguments:
+        path -- the file to read
+        digest -- the digest of the current dictionary
+        alphabet -- the letters the words are made of
+
+        Returns:
+        The index, or None if the file is missing, corrupt, or was built
+        from a different dictionary or alphabet.
+        """
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            (magic, source, size, count, letters) = cls.header.unpack_from(buffer)
+        except struct.error:
+            return None
+        offset = cls.header.size
+        nbytes = (count + 7) // 8
+        expected = offset + letters + count * size + size * letters * nbytes
+        if (magic != cls.magic or source != digest or len(buffer) != expected
+                or buffer[offset:offset + letters].decode('ascii') != ''.join(alphabet)):
+            return None
+        offset += letters
+
+        index = cls.__new__(cls)
+        index.size = size
+        index.alphabet = list(alphabet)
+        index.words = WordMatrix(buffer, offset, count, size)
+        offset += count * size
+
+        index.postings = list()
+        for i in range(size):
+            postings = dict()
+            for letter in alphabet:
+                postings[letter] = int.from_bytes(buffer[offset:offset + nbytes], 'little')
+                offset += nbytes
+            index.postings.append(postings)
+        return index
+
+
+class WordMatrix(Sequence):
+    """
+    A read-only sequence of same-length words stored as rows of bytes in a
+    buffer, such as a memory-mapped index file.
+    """
+
+    def __init__(self, buffer, offset, count, size):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.size = size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start = self.offset + i * self.size
+        return self.buffer[start:start + self.size].decode('ascii')
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        # A memory map can't be pickled, so the words are copied out.
+        return (list, (list(self),))
+
+
 class WordSquareVariable(BaseVariable):
     """
     A variable in the word square CSP.
@@ -86,6 +294,8 @@ class WordSquareVariable(BaseVariable):
     value -- the letter assigned to this variable, or None
     constraints -- a set of constraints covering this variable
     """
+    __slots__ = ()
+
     def __init__(self, csp, name):
         BaseVariable.__init__(self, csp, name)
         self.domain = WordSquare.alphabet[:]
@@ -93,10 +303,12 @@ class WordSquareVariable(BaseVariable):
     def ordered_domain(self):
         """
         Returns:
-        This variable's domain as a list of values, sorted by most common
-        to least common.
+        This variable's domain as a list of values, sorted by the number of
+        words still possible in its row and column with each letter in
+        this square, most first. The counts come from the constraints'
+        sets of valid words, which propagation keeps up to date.
         """
-        return sorted(self.domain, key=lambda c: self.csp.letters_count[c], reverse=True)
+        return self.least_constraining_values()
 
     def find_constraint(self, other_var):
         """
@@ -117,52 +329,32 @@ class WordSquareVariable(BaseVariable):
         return None
 
 
-class WordSquareConstraint(BaseConstraint):
+class WordSquareConstraint(TableConstraint):
     """
     A constraint in the word square CSP. The constraint is of the form
     [V_0 = d_0, V_1 = d_1, ..., V_n = d_n] and is satisfied if there's a
     word W such that W[0] = d_0, W[1] = d_1, ..., W[n] = d_n.
 
+    It's a table constraint whose rows are the index's words, and whose
+    support masks are the index's postings, shared by every constraint
+    over the same index.
+
     Public instance variables:
     variables -- a list of variables this constraint covers, in order from
         top to bottom or left to right
-
-    Public class variables:
-    lettermap -- a map: string index i -> map: letter -> words whose
-        i-th character is letter
-
-    Unpublished instance variables:
-    indices -- a map: variable v -> index i such that `self.variables[i] is v`
+    index -- the WordIndex of the words the constraint allows
     """
-    def __init__(self, variables):
+    def __init__(self, variables, index):
         """
         Constructor.
 
         Arguments:
         variables -- a set of variables this constraint covers
+        index -- the WordIndex of the words the constraint allows
         """
-        BaseConstraint.__init__(self, sorted(iter(variables), key=WordSquareVariable.get_name))
-        self.indices = {self.variables[i].name: i for i in range(len(self.variables))}
-
-    def is_satisfiable(self, variable, assignment):
-        """
-        Is the constraint, including variables already assigned values,
-        satisfiable with the given assignment `variable.value = assignment`?
-
-        Arguments:
-        variable -- the variable we're assigning to
-        assignment -- the value we're assigning to the variable
-
-        Returns:
-        A list of words W such that for all indices i in self.variables,
-        W[i] is in self.variables[i].domain AND `W[i] = assignment` if
-        `self.variables[i] is variable`.
-        """
-        words = self.lettermap[self.indices[variable.name]][assignment]
-        for other_var in self.variables:
-            if other_var is not variable:
-                words = [w for w in words if w[self.indices[other_var.name]] in other_var.domain]
-        return words
+        TableConstraint.__init__(self, sorted(iter(variables), key=WordSquareVariable.get_name),
+                                 index.words, index.postings)
+        self.index = index
 
     def __repr__(self):
         return "[Constraint] %s" % [var.name for var in self.variables]
@@ -3,7 +3,7 @@ from distutils.core import setup
 setup(
     name='ConstraintSatisfactionProblem',
     version='0.1.1',
-    py_modules=['csp'],
+    py_modules=['csp', 'benchmark'],
     url='https://github.com/jaywritescode/ConstraintSatisfactionProblem',
     license='MIT',
     author='jay harris',
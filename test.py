@@ -43,5 +43,948 @@ class BaseVariableTestCase(unittest.TestCase):
         self.assertSetEqual(set(), csp.variables['T'].neighbors)
         self.assertSetEqual({csp.variables[x] for x in ['WA', 'SA', 'Q']}, csp.variables['NT'].neighbors)
 
+def test_freeze_builds_arc_index(australia):
+    australia.freeze()
+    nt, sa = australia.variables['NT'], australia.variables['SA']
+    assert set(australia.arc_index[nt]) == nt.neighbors
+    assert australia.arc_index[nt][sa] == nt.find_constraints_between(sa)
+    assert australia.arc_index[australia.variables['T']] == {}
+
+
+def test_solve_with_residual_supports(australia):
+    solution = australia.solve(propagation='ac3rm')
+    for pair in australia_neighbors:
+        a, b = (solution.variables[p] for p in pair)
+        assert a.value is not None and a.value != b.value
+
+
+def test_solve_rejects_unknown_propagation(australia):
+    with pytest.raises(ValueError):
+        australia.solve(propagation='ac4')
+
+
+def test_bitset_domain():
+    import csp
+
+    domain = csp.BitsetDomain('abcde')
+    domain.discard('b')
+    domain.difference_update('dz')
+    assert list(domain) == ['a', 'c', 'e'] and len(domain) == 3
+    assert 'b' not in domain and 'z' not in domain
+
+    other = csp.BitsetDomain('ce', universe=domain)
+    assert other.index is domain.index
+    assert list(domain & other) == ['c', 'e']
+
+
+def test_variable_domain_converts_to_bitset(australia):
+    import csp
+
+    wa = australia.variables['WA']
+    assert isinstance(wa.domain, csp.BitsetDomain)
+    universe = wa.domain.index
+    wa.domain = ['red']
+    assert wa.domain.index is universe and list(wa.domain) == ['red']
+
+
+def test_domains_share_universes_within_a_problem():
+    import csp
+
+    problems = [csp.ConstraintSatisfactionProblem() for _ in range(2)]
+    variables = [csp.BaseVariable(problem, name) for problem in problems for name in 'xy']
+    for var in variables:
+        var.domain = range(3)
+    (x, y, other, _) = variables
+    assert x.domain.universe is y.domain.universe and x.domain.index is y.domain.index
+    assert other.domain.index is not x.domain.index
+
+
+def test_undo_restores_domains_in_order(australia):
+    australia.freeze()
+    before = {name: list(var.domain) for (name, var) in australia.variables.items()}
+
+    sa = australia.variables['SA']
+    australia._set_bits(sa.domain, 1 << sa.domain.index['red'])
+    australia._ac3(sa)
+    assert 'red' not in australia.variables['WA'].domain
+
+    australia._undo(0)
+    assert {name: list(var.domain) for (name, var) in australia.variables.items()} == before
+
+
+def test_iter_solutions(australia):
+    solutions = list(australia.iter_solutions())
+    assert len(solutions) == 18
+    assert len({tuple(sorted(s.items())) for s in solutions}) == 18
+    for solution in solutions:
+        assert all(solution[a] != solution[b] for (a, b) in australia_neighbors)
+    assert all(var.value is None for var in australia.variables.values())
+    assert australia.stats.solutions == 18 and australia.stats.nodes >= 18
+
+
+def test_count_solutions(australia):
+    assert australia.count_solutions(limit=4) == 4
+    assert australia.count_solutions() == 18
+
+
+def test_constraints_added_after_solving_are_used(australia):
+    import csp
+
+    assert australia.count_solutions() == 18
+    (wa, t) = (australia.variables['WA'], australia.variables['T'])
+    constraint = csp.AllDifferentConstraint([wa, t])
+    australia.constraints.add(constraint)
+    assert australia.count_solutions() == 12
+    australia.constraints.discard(constraint)
+    for var in constraint.variables:
+        var.constraints.discard(constraint)
+    assert australia.count_solutions() == 18
+
+
+def test_variables_added_after_solving_are_used():
+    import csp
+
+    problem = all_different({'x': range(2), 'y': range(2)})
+    assert problem.count_solutions() == 2
+    problem.variables['z'] = csp.BaseVariable(problem, 'z')
+    problem.variables['z'].domain = range(3)
+    assert problem.count_solutions() == 6
+    del problem.variables['z']
+    assert problem.count_solutions() == 2
+
+
+def test_count_solutions_matches_brute_force():
+    import csp
+    import itertools
+    import random
+
+    class AllowedTuples(csp.BaseConstraint):
+        def __init__(self, variables, allowed):
+            csp.BaseConstraint.__init__(self, variables)
+            self.allowed = allowed
+
+        def is_satisfiable(self, variable, assignment):
+            i = self.variables.index(variable)
+            return any(t[i] == assignment and all(x in v.domain for (x, v) in zip(t, self.variables))
+                       for t in self.allowed)
+
+    for seed in range(100, 140):
+        rng = random.Random(seed)
+        (n, d) = (rng.randint(3, 7), rng.randint(2, 4))
+        problem = csp.ConstraintSatisfactionProblem()
+        for name in range(n):
+            problem.variables[name] = csp.BaseVariable(problem, name)
+            problem.variables[name].domain = range(d)
+        tables = list()
+        for _ in range(rng.randint(2, 9)):
+            names = rng.sample(range(n), rng.choice([2, 2, 3]))
+            allowed = {t for t in itertools.product(range(d), repeat=len(names)) if rng.random() < 0.6}
+            tables.append((names, allowed))
+            problem.constraints.add(AllowedTuples([problem.variables[x] for x in names], allowed))
+
+        expected = sum(1 for a in itertools.product(range(d), repeat=n)
+                       if all(tuple(a[x] for x in names) in allowed for (names, allowed) in tables))
+        assert problem.count_solutions() == expected, seed
+
+
+def test_search_pauses_and_resumes(australia):
+    import csp
+
+    search = csp.Search(australia)
+    assert search.run(node_limit=2) is None
+    assert search.status == 'paused' and search.nodes == 2
+    while search.run(node_limit=1) is None:
+        pass
+    assert search.status == 'solved'
+    assert all(var.value for var in australia.variables.values())
+
+
+def test_paused_search_can_be_pickled():
+    import csp
+    import pickle
+
+    path = csp.ConstraintSatisfactionProblem()
+    for name in range(6):
+        path.variables[name] = csp.BaseVariable(path, name)
+        path.variables[name].domain = [0, 1, 2]
+    for name in range(1, 6):
+        path.constraints.add(csp.AllDifferentConstraint(
+            [path.variables[name - 1], path.variables[name]]))
+
+    search = csp.Search(path)
+    assert search.run(node_limit=2) is None
+    resumed = pickle.loads(pickle.dumps(search))
+    assert resumed.run() is True
+    values = [resumed.csp.variables[name].value for name in range(6)]
+    assert all(a != b for (a, b) in zip(values, values[1:]))
+
+
+def test_search_is_not_limited_by_recursion_depth():
+    import csp
+    import sys
+
+    chain = csp.ConstraintSatisfactionProblem()
+    names = range(sys.getrecursionlimit() + 200)
+    for name in names:
+        chain.variables[name] = csp.BaseVariable(chain, name)
+        chain.variables[name].domain = [0, 1]
+    for name in names[1:]:
+        chain.constraints.add(csp.AllDifferentConstraint(
+            [chain.variables[name - 1], chain.variables[name]]))
+
+    assert chain.solve() is chain
+    assert all(chain.variables[n].value != chain.variables[n - 1].value for n in names[1:])
+
+
+def test_luby_sequence():
+    import csp
+
+    assert [csp.luby(i) for i in range(1, 16)] == [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8]
+
+
+@pytest.mark.parametrize('heuristic', ['mrv', 'dom/wdeg'])
+@pytest.mark.parametrize('restarts', [None, 'luby', 'geometric'])
+def test_heuristics_and_restarts(australia, heuristic, restarts):
+    import csp
+
+    # Two colors can't color the mainland, so the search fails repeatedly
+    # and restarts before proving there's no solution.
+    for var in australia.variables.values():
+        var.domain = ['red', 'green']
+    search = csp.Search(australia, heuristic=heuristic, restarts=restarts,
+                        restart_scale=1, seed=7)
+    assert search.run() is False
+    if restarts:
+        assert search.restarts > 0 and search.nogoods
+
+
+def test_seeded_search_is_reproducible(australia):
+    import csp
+
+    orders = list()
+    for _ in range(2):
+        search = csp.Search(australia, heuristic='dom/wdeg', seed=11)
+        assert search.run()
+        orders.append([frame.variable.name for frame in search._stack])
+        search.close()
+    assert orders[0] == orders[1]
+
+
+def test_solve_with_workers(australia):
+    solution = australia.solve(workers=3)
+    assert solution is australia
+    for pair in australia_neighbors:
+        a, b = (solution.variables[p] for p in pair)
+        assert a.value is not None and a.value != b.value
+
+
+def test_solve_with_workers_leaves_the_domains_reversible(australia):
+    assert australia.solve(workers=2) is australia
+    assert australia.count_solutions() == 18
+    with australia.assume(values={'WA': 'red'}):
+        assert australia.solve(workers=2) is australia
+        assert australia.variables['WA'].value == 'red'
+    assert all(len(var.domain) == 3 for var in australia.variables.values())
+    assert australia.count_solutions() == 18
+
+
+def test_solve_with_workers_without_solution(australia):
+    for var in australia.variables.values():
+        var.domain = ['red', 'green']
+    assert australia.solve(workers=2) is None
+
+
+def report_or_die(index, results):
+    import os
+    import signal
+
+    if index == 1:
+        os.kill(os.getpid(), signal.SIGKILL)
+    results.put(index)
+
+
+def test_worker_killed_without_a_result_is_an_error():
+    import csp
+
+    reports = csp._run_in_processes(report_or_die, [(0,), (1,), (2,)], 3)
+    with pytest.raises(RuntimeError):
+        list(reports)
+
+
+def all_different(domains):
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for (name, domain) in domains.items():
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = domain
+    problem.constraints.add(csp.AllDifferentConstraint(problem.variables.values()))
+    return problem
+
+
+def test_all_different_is_generalized_arc_consistent():
+    problem = all_different({'x': [1, 2], 'y': [1, 2], 'z': [1, 2, 3], 'w': [1, 2, 3, 4]})
+    problem._ac3()
+    assert {name: set(var.domain) for (name, var) in problem.variables.items()} == \
+        {'x': {1, 2}, 'y': {1, 2}, 'z': {3}, 'w': {4}}
+
+
+def test_all_different_detects_pigeonholes():
+    problem = all_different({'x': [1, 2], 'y': [1, 2], 'z': [1, 2], 'w': [1, 2, 3]})
+    problem._ac3()
+    assert problem._wipeout is not None
+    assert problem.solve() is None
+
+
+def linear(domains, coefficients, relation, constant):
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for (name, domain) in domains.items():
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = domain
+    problem.constraints.add(csp.LinearConstraint(problem.variables.values(), coefficients,
+                                                 relation, constant))
+    return problem
+
+
+@pytest.mark.parametrize('relation', ['==', '<=', '>='])
+def test_linear_constraint_is_generalized_arc_consistent(relation):
+    import itertools
+    import operator
+    import random
+
+    compare = {'==': operator.eq, '<=': operator.le, '>=': operator.ge}[relation]
+    rng = random.Random(relation)
+    for _ in range(50):
+        domains = {name: rng.sample(range(-3, 5), rng.randint(1, 5)) for name in 'xyz'}
+        coefficients = [rng.choice([-3, -2, -1, 1, 2, 3]) for _ in domains]
+        constant = rng.randint(-6, 6)
+        problem = linear(domains, coefficients, relation, constant)
+        supported = {name: set() for name in domains}
+        for values in itertools.product(*domains.values()):
+            if compare(sum(c * v for (c, v) in zip(coefficients, values)), constant):
+                for (name, value) in zip(domains, values):
+                    supported[name].add(value)
+
+        problem._ac3()
+        if problem._wipeout is not None:
+            assert not any(supported.values())
+        else:
+            assert {name: set(var.domain) for (name, var) in problem.variables.items()} == supported
+
+
+def test_linear_constraint_merges_repeated_variables():
+    import csp
+
+    problem = linear({'x': range(10), 'y': range(10)}, [1, 1], '==', 9)
+    (x, y) = (problem.variables['x'], problem.variables['y'])
+    constraint = csp.LinearConstraint([x, y, x], [2, 1, -1], '>=', 17)
+    assert constraint.coefficients == [1, 1]
+    assert not constraint.is_satisfiable(x, 7)
+    assert constraint.is_satisfiable(x, 8)
+    with pytest.raises(ValueError):
+        csp.LinearConstraint([x], [1], '<')
+
+
+def test_linear_constraint_reports_an_empty_domain():
+    import csp
+
+    problem = linear({'x': range(4), 'y': range(4)}, [1, 1], '==', 0)
+    problem.constraints.add(csp.AllDifferentConstraint(problem.variables.values()))
+    assert problem.solve() is None
+    assert problem.count_solutions() == 0
+    (x, y) = (problem.variables['x'], problem.variables['y'])
+    x.domain = []
+    constraint = csp.LinearConstraint([x, y], [1, 1], '==', 0)
+    assert constraint.filter() == {x: 0}
+    assert not constraint.is_satisfiable(y, 0)
+
+
+def test_table_constraint_is_generalized_arc_consistent():
+    import csp
+    import itertools
+    import random
+
+    rng = random.Random(15)
+    for _ in range(50):
+        problem = csp.ConstraintSatisfactionProblem()
+        for name in 'xyz':
+            problem.variables[name] = csp.BaseVariable(problem, name)
+            problem.variables[name].domain = range(4)
+        table = [row for row in itertools.product(range(4), repeat=3) if rng.random() < 0.1]
+        problem.constraints.add(csp.TableConstraint(problem.variables.values(), table))
+        x = problem.variables['x']
+        x.domain.intersection_update({0, 1, 2})
+
+        problem._ac3()
+        if not table or problem._wipeout is not None:
+            assert not [row for row in table if row[0] != 3]
+            continue
+        for (i, var) in enumerate(problem.variables.values()):
+            assert set(var.domain) == {row[i] for row in table if row[0] != 3}
+
+
+def test_table_constraint_restores_its_rows_on_undo():
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'xy':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = range(3)
+    (x, y) = problem.variables.values()
+    problem.constraints.add(csp.TableConstraint([x, y], [(0, 0), (0, 1), (1, 2), (2, 2)]))
+    problem._ac3()
+    mark = len(problem._trail)
+    problem._set_bits(x.domain, x.domain.mask([0]))
+    problem._ac3(x)
+    assert set(y.domain) == {0, 1}
+    problem._undo(mark)
+    assert set(y.domain) == {0, 1, 2}
+    problem._set_bits(x.domain, x.domain.mask([1, 2]))
+    problem._ac3(x)
+    assert set(y.domain) == {2}
+    assert problem.count_solutions() == 2
+
+
+def test_least_constraining_values_come_first():
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'xyz':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = range(3)
+    (x, y, z) = problem.variables.values()
+    table = csp.TableConstraint([x, y], [(0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (2, 2)])
+    problem.constraints.add(table)
+    problem.constraints.add(csp.AllDifferentConstraint([x, z]))
+    problem._ac3()
+    assert table.support_counts(x) == {0: 1, 1: 2, 2: 3}
+    assert x.least_constraining_values() == [2, 1, 0]
+
+    # The counts follow domain changes that haven't been propagated yet.
+    mark = len(problem._trail)
+    problem._set_bits(y.domain, y.domain.mask([0]))
+    assert table.support_counts(x) == {0: 1, 1: 1, 2: 1}
+    assert x.least_constraining_values() == [0, 1, 2]
+    problem._undo(mark)
+
+    search = csp.Search(problem, value_order='lcv')
+    assert search.run() and x.value == 2
+    search.close()
+    with pytest.raises(ValueError):
+        csp.Search(problem, value_order='random')
+
+
+def test_solve_records_stats(australia):
+    australia.solve(profile=True)
+    stats = australia.stats
+    assert stats.nodes >= len(australia_names) and stats.solutions == 1
+    assert stats.revisions['AllDifferentConstraint'] > 0
+    assert set(stats.time) == set(stats.revisions)
+    assert stats.as_dict()['pruned'] == stats.pruned
+
+
+def test_tracer_sees_assignments_backtracks_and_wipeouts():
+    import csp
+
+    class Recorder(csp.SearchTracer):
+        def __init__(self):
+            self.events = list()
+
+        def on_assign(self, search, variable, value):
+            self.events.append(('assign', variable.name, value))
+
+        def on_backtrack(self, search, variable, value):
+            self.events.append(('backtrack', variable.name, value))
+
+        def on_wipeout(self, search, variable, constraint):
+            self.events.append(('wipeout', variable.name))
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'xyz':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = [1, 2]
+    for pair in ('xy', 'xz', 'yz'):
+        problem.constraints.add(csp.TableConstraint(
+            [problem.variables[name] for name in pair], [(1, 2), (2, 1)]))
+
+    recorder = Recorder()
+    assert problem.solve(tracer=recorder) is None
+    assert [event[0] for event in recorder.events] == \
+        ['assign', 'wipeout', 'backtrack', 'assign', 'wipeout', 'backtrack']
+    assert recorder.events[0] == ('assign', 'x', 1)
+    assert recorder.events[2] == ('backtrack', 'x', 1)
+    assert problem.stats.nodes == 1
+
+
+def test_benchmark_generators():
+    import benchmark
+
+    assert benchmark.queens(6).count_solutions() == 4
+    coloring = benchmark.graph_coloring(10, 12, 3, seed=5)
+    assert len(coloring.constraints) == 12
+    latin = benchmark.latin_square(5, filled=0.3, seed=1).solve()
+    for i in range(5):
+        assert {latin.variables[(i, j)].value for j in range(5)} == set(range(5))
+        assert {latin.variables[(j, i)].value for j in range(5)} == set(range(5))
+
+
+def test_benchmark_runs_are_reproducible():
+    import benchmark
+
+    results = [benchmark.run_case(lambda: benchmark.graph_coloring(20, 45, 3, seed=7), 'count')
+               for _ in range(2)]
+    assert results[0]['propagations'] == results[1]['propagations']
+    assert results[0]['nodes'] == results[1]['nodes']
+
+    old = {'results': {'case': results[0]}}
+    new = {'results': {'case': dict(results[0], nodes=results[0]['nodes'] + 1,
+                                    time=results[0]['time'] * 2 + 1)}}
+    assert len(benchmark.compare(old, old)) == 0
+    assert len(benchmark.compare(new, old)) == 2
+
+
+def test_benchmark_counts_match_the_baseline():
+    import benchmark
+    import json
+
+    with open(benchmark.BASELINE) as f:
+        baseline = json.load(f)['results']
+    names = set()
+    for (name, factory, mode) in benchmark.cases('quick'):
+        names.add(name)
+        result = benchmark.solve_case(factory, mode)
+        for key in ('solutions', 'nodes', 'propagations'):
+            assert result[key] == baseline[name][key], (name, key)
+    assert names == set(baseline)
+
+
+def pigeonholes(n):
+    import benchmark
+
+    return benchmark.graph_coloring(n, n * (n - 1) // 2, n - 1)
+
+
+def test_solve_gives_up_after_node_limit_or_timeout():
+    import time
+
+    problem = pigeonholes(12)
+    assert problem.solve(node_limit=50) is None
+    assert problem.status == 'unknown' and problem.stats.nodes == 50
+    assert all(var.value is None for var in problem.variables.values())
+
+    start = time.perf_counter()
+    assert problem.solve(timeout=0.2) is None
+    assert problem.status == 'unknown'
+    assert time.perf_counter() - start < 5
+
+    small = pigeonholes(4)
+    assert small.solve() is None
+    assert small.status == 'unsatisfiable'
+
+
+def test_solve_can_be_cancelled():
+    import csp
+    import threading
+
+    problem = pigeonholes(12)
+    token = csp.CancellationToken()
+    threading.Timer(0.1, token.cancel).start()
+    assert problem.solve(cancel=token) is None
+    assert problem.status == 'unknown'
+
+    assert pigeonholes(12).solve(workers=2, cancel=token) is None
+
+
+def test_solve_async_interleaves_searches(australia):
+    import asyncio
+    import concurrent.futures
+
+    async def main():
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            return await asyncio.gather(pigeonholes(12).solve_async(timeout=0.3, slice_nodes=10),
+                                        australia.solve_async(slice_nodes=1),
+                                        pigeonholes(5).solve_async(executor=executor))
+
+    (hard, solved, unsatisfiable) = asyncio.run(main())
+    assert hard is None
+    assert solved is australia and australia.status == 'solved'
+    assert unsatisfiable is None
+
+
+def test_assumptions_are_retracted(australia):
+    import csp
+
+    australia.solve()
+    wa = australia.variables['WA']
+    with australia.assume(values={'WA': 'red'}, removed={'SA': ['green']}) as assumption:
+        assert assumption.consistent
+        assert australia.solve() is australia
+        assert wa.value == 'red' and australia.variables['SA'].value != 'green'
+        assert australia.count_solutions() == 3
+
+        nt = australia.variables['NT']
+        with australia.assume(constraints=[csp.AllDifferentConstraint([nt, australia.variables['T']])]):
+            assert australia.count_solutions() == 2
+        assert len(nt.constraints) == 3
+
+        assert not australia.assume(values={'NT': 'red'}).consistent
+        assert australia.solve() is None and australia.status == 'unsatisfiable'
+        australia.retract()
+
+    assert all(var.value is None for var in australia.variables.values())
+    assert set(wa.domain) == {'red', 'green', 'blue'}
+    assert australia.count_solutions() == 18
+
+
+def test_root_wipeout_is_remembered():
+    import csp
+
+    problem = linear({'x': range(4), 'y': range(4)}, [1, 1], '==', 0)
+    problem.constraints.add(csp.AllDifferentConstraint(problem.variables.values()))
+    assert problem.solve() is None
+    assert problem.stats.revisions
+    assert problem.solve() is None and problem.status == 'unsatisfiable'
+    assert not problem.stats.revisions
+    problem.variables['x'].domain = range(1, 4)
+    assert problem.solve() is None
+    assert problem.stats.revisions
+
+
+def test_assumptions_keep_learned_nogoods():
+    import csp
+
+    problem = pigeonholes(6)
+    problem.variables[0].domain = range(6)
+    with problem.assume(removed={0: [5]}):
+        search = csp.Search(problem, restarts='luby', restart_scale=1)
+        assert search.run() is False and search.nogoods
+        assert csp.Search(problem).nogoods == search.nogoods
+    assert not csp.Search(problem).nogoods
+    assert problem.solve() is problem
+
+
+def test_support_cache_gives_the_same_answers():
+    import benchmark
+    import csp
+
+    problem = benchmark.queens(7)
+    problem.support_cache = csp.SupportCache(maxsize=64)
+    assert problem.count_solutions() == 40
+    cache = problem.support_cache
+    assert cache.hits and cache.misses and cache.evictions
+    assert len(cache) == 64
+    assert 0 < cache.hit_rate < 1
+
+    class NonZero(csp.BaseConstraint):
+        cacheable = False
+
+        def is_satisfiable(self, variable, assignment):
+            return assignment != 0
+
+    problem = all_different({'x': range(3), 'y': range(3)})
+    problem.constraints.add(NonZero(problem.variables.values()))
+    problem.support_cache = csp.SupportCache()
+    assert problem.count_solutions() == 2
+    assert problem.support_cache.hits == problem.support_cache.misses == 0
+
+
+def test_compiled_problem_round_trips(tmp_path):
+    import benchmark
+    import csp
+
+    for factory in (lambda: benchmark.queens(6), lambda: benchmark.latin_square(4),
+                    lambda: benchmark.cryptarithm("send + more = money")):
+        compiled = factory().compile()
+        assert compiled.scope_offsets[-1] == len(compiled.scope)
+        path = tmp_path / 'problem.csp'
+        compiled.save(str(path))
+        loaded = csp.CompiledProblem.load(str(path))
+        assert loaded.names == compiled.names
+        assert list(loaded.neighbors) == list(compiled.neighbors)
+        assert loaded.to_csp().count_solutions() == factory().count_solutions()
+
+    with pytest.raises(ValueError):
+        csp.CompiledProblem.from_bytes(b'not a problem')
+
+
+def test_compiled_table_constraint_keeps_its_rows():
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'xyz':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = 'abc'
+    (x, y, z) = problem.variables.values()
+    problem.constraints.add(csp.TableConstraint([x, y], [('a', 'b'), ('b', 'c'), ('c', 'a')]))
+    problem.constraints.add(csp.AllDifferentConstraint([y, z]))
+    x.domain = 'ab'
+
+    compiled = csp.CompiledProblem.from_bytes(problem.compile().to_bytes())
+    assert compiled.kinds == ['table', 'alldiff']
+    rebuilt = compiled.to_csp()
+    assert list(rebuilt.variables['x'].domain) == ['a', 'b']
+    assert sorted((s['x'], s['y'], s['z']) for s in rebuilt.iter_solutions()) == \
+        sorted((s['x'], s['y'], s['z']) for s in problem.iter_solutions())
+
+
+def test_compiled_tables_are_stored_once_and_shared(tmp_path):
+    import csp
+    import pickle
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'abcd':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = 'xyz'
+    (a, b, c, d) = problem.variables.values()
+    table = [('x', 'y'), ('y', 'z'), ('z', 'x')]
+    supports = csp.TableConstraint.build_supports(table, 2)
+    problem.constraints.add(csp.TableConstraint([a, b], table, supports))
+    problem.constraints.add(csp.TableConstraint([c, d], table, supports))
+
+    compiled = problem.compile()
+    assert list(compiled.rows) == [0, 1, 1, 2, 2, 0]
+    compiled.save(str(tmp_path / 'problem.cspc'))
+    rebuilt = csp.CompiledProblem.load(str(tmp_path / 'problem.cspc')).to_csp()
+    (first, second) = sorted(rebuilt.constraints, key=csp.BaseConstraint.get_id)
+    assert first.table is second.table and first.supports is second.supports
+    assert list(first.table) == table
+    assert first.supports == csp.TableConstraint.build_supports(table, 2)
+    assert pickle.loads(pickle.dumps(first.table)) == table
+    assert rebuilt.count_solutions() == problem.count_solutions() == 9
+
+
+def test_compiled_table_constraint_drops_rows_outside_the_domains():
+    import csp
+
+    problem = csp.ConstraintSatisfactionProblem()
+    for name in 'xy':
+        problem.variables[name] = csp.BaseVariable(problem, name)
+        problem.variables[name].domain = [0, 1]
+    (x, y) = problem.variables.values()
+    problem.constraints.add(csp.TableConstraint([x, y], [(0, 1), (1, 0), (2, 2)]))
+
+    compiled = csp.CompiledProblem.from_bytes(problem.compile().to_bytes())
+    assert list(compiled.rows) == [0, 1, 1, 0]
+    assert sorted((s['x'], s['y']) for s in compiled.to_csp().iter_solutions()) == [(0, 1), (1, 0)]
+
+
+def test_components_are_solved_separately(australia):
+    components = australia.components()
+    assert [[var.name for var in c] for c in components] == [
+        ['WA', 'NT', 'Q', 'NSW', 'V', 'SA'], ['T']]
+
+    assert australia.count_solutions(decompose=True) == 18
+    assert australia.stats.solutions == 18
+    assert australia.count_solutions(limit=5, decompose=True) == 5
+    assert australia.count_solutions(decompose=True, workers=2) == 18
+    assert all(var.csp is australia for var in australia.variables.values())
+
+    for workers in (None, 2):
+        assert australia.solve(decompose=True, workers=workers) is australia
+        assert australia.status == 'solved'
+        for pair in australia_neighbors:
+            a, b = (australia.variables[p] for p in pair)
+            assert a.value is not None and a.value != b.value
+        assert australia.variables['T'].value is not None
+
+
+def test_decomposed_solve_leaves_the_domains_reversible(australia):
+    import benchmark
+
+    assert australia.solve(decompose=True) is australia
+    assert australia.count_solutions() == 18
+    with australia.assume(values={'WA': 'red'}):
+        assert australia.solve(decompose=True) is australia
+    assert australia.count_solutions() == 18
+
+    queens = benchmark.queens(8)
+    with queens.assume(values={0: 0}):
+        assert queens.solve(decompose=True, restarts='luby') is queens
+    assert all(len(var.domain) == 8 for var in queens.variables.values())
+    assert queens.count_solutions() == 92
+
+
+def test_component_searches_prune_under_the_assumptions():
+    import csp
+
+    problem = pigeonholes(5)
+    with problem.assume(removed={0: [0]}):
+        # Restarting often records nogoods at the root, whose removals last
+        # only as long as the assumptions.
+        for sub in problem._split():
+            search = csp.Search(sub, restarts='luby', restart_scale=1)
+            assert search.run() is False and search.restarts
+            search.close()
+        problem._merge()
+    assert all(len(var.domain) == 4 for var in problem.variables.values())
+
+
+def test_unsatisfiable_component_fails_the_whole_problem(australia):
+    australia.variables['T'].domain = []
+    assert australia.count_solutions(decompose=True) == 0
+    assert australia.solve(decompose=True) is None
+    assert australia.status == 'unsatisfiable'
+
+
+def test_lex_leq_constraint_is_generalized_arc_consistent():
+    import csp
+    import itertools
+    import random
+
+    rng = random.Random(23)
+    for _ in range(100):
+        problem = csp.ConstraintSatisfactionProblem()
+        domains = dict()
+        for name in 'abcdef':
+            domains[name] = rng.sample(range(4), rng.randint(1, 4))
+            problem.variables[name] = csp.BaseVariable(problem, name)
+            problem.variables[name].domain = domains[name]
+        (xs, ys) = ('abc', 'def')
+        problem.constraints.add(csp.LexLeqConstraint([problem.variables[n] for n in xs],
+                                                     [problem.variables[n] for n in ys]))
+        supported = {name: set() for name in domains}
+        for values in itertools.product(*domains.values()):
+            assignment = dict(zip(domains, values))
+            if [assignment[n] for n in xs] <= [assignment[n] for n in ys]:
+                for (name, value) in assignment.items():
+                    supported[name].add(value)
+
+        problem._ac3()
+        if problem._wipeout is not None:
+            assert not any(supported.values())
+        else:
+            assert {name: set(var.domain) for (name, var) in problem.variables.items()} == supported
+
+
+def test_symmetries_keep_one_solution_of_each_orbit():
+    import benchmark
+
+    problem = benchmark.graph_coloring(12, 20, 3, seed=1)
+    names = list(problem.variables)
+    orbits = set()
+    for solution in problem.iter_solutions():
+        relabel = dict()
+        orbits.add(tuple(relabel.setdefault(solution[name], len(relabel)) for name in names))
+    problem.add_value_symmetry(range(3))
+    assert problem.count_solutions() == len(orbits) == 3
+
+    # Reversing the order of the columns maps a queens solution to another.
+    problem = benchmark.queens(6)
+    assert problem.add_symmetry({}) is None
+    problem.add_symmetry({i: 5 - i for i in range(6)})
+    solutions = [tuple(s[i] for i in range(6)) for s in problem.iter_solutions()]
+    assert len(solutions) == 2
+    assert all(s <= s[::-1] for s in solutions)
+
+
+def example(name):
+    import importlib
+    import os
+    import sys
+
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+    if examples not in sys.path:
+        sys.path.append(examples)
+    return importlib.import_module(name)
+
+
+def test_word_square_transpose_symmetry_is_broken():
+    import os
+
+    wordsquare = example('wordsquare')
+    words = wordsquare.WordSquare(os.path.join(os.path.dirname(wordsquare.__file__),
+                                               'resources', 'words.txt'))
+    square = words.csp(5)
+    assert square.solve() is square
+    rows = [''.join(square.variables[(i, j)].value for j in range(5)) for i in range(5)]
+    columns = [''.join(row[j] for row in rows) for j in range(5)]
+    assert rows <= columns
+    # Only the squares that are their own transposes aren't counted twice.
+    both = list(words.csp(2, symmetry=False).iter_solutions())
+    symmetric = sum(1 for s in both if s[(0, 1)] == s[(1, 0)])
+    assert words.csp(2).count_solutions() * 2 == len(both) + symmetric
+
+
+def test_cryptarithm_batch_writes_json_lines():
+    import io
+    import json
+
+    cryptarithmetic = example('cryptarithmetic')
+    lines = io.StringIO("send + more = money\n"
+                        "\n"
+                        "# a comment\n"
+                        "not a puzzle\n"
+                        "  one + two + two + three + three = eleven\n")
+    out = io.StringIO()
+    assert cryptarithmetic.solve_batch(lines, out, workers=1) == 2
+    results = {r['line']: r for r in map(json.loads, out.getvalue().splitlines())}
+    assert sorted(results) == [1, 4, 5]
+
+    money = results[1]['solution']
+    assert money == dict(s=9, e=5, n=6, d=7, m=1, o=0, r=8, y=2)
+    assert results[4] == {'line': 4, 'puzzle': 'not a puzzle', 'error': 'invalid puzzle',
+                          'time': results[4]['time']}
+
+    eleven = results[5]
+    assert eleven['puzzle'] == 'one + two + two + three + three = eleven'
+    digits = eleven['solution']
+    (one, two, three, total) = (int(''.join(str(digits[c]) for c in word))
+                                for word in ('one', 'two', 'three', 'eleven'))
+    assert one + 2 * two + 2 * three == total
+    assert eleven['nodes'] > 0
+
+
+def test_word_index_round_trips_through_the_cache(tmp_path):
+    import os
+    import pickle
+    import stat
+
+    wordsquare = example('wordsquare')
+    words = tmp_path / 'words.txt'
+    words.write_text('cat\ndog\nact\nox\n')
+    square = wordsquare.WordSquare(str(words), str(tmp_path / 'cache'))
+    built = square.index(3)
+    assert built.words == ['CAT', 'DOG', 'ACT']
+    path = tmp_path / 'cache' / 'words.txt.3.idx'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+    loaded = wordsquare.WordSquare(str(words), str(tmp_path / 'cache')).index(3)
+    assert isinstance(loaded.words, wordsquare.WordMatrix)
+    assert list(loaded.words) == built.words
+    assert pickle.loads(pickle.dumps(loaded.words)) == built.words
+    assert loaded.postings == built.postings
+
+
+def test_word_index_is_rebuilt_when_stale_or_truncated(tmp_path):
+    wordsquare = example('wordsquare')
+    words = tmp_path / 'words.txt'
+    words.write_text('cat\ndog\n')
+    cache = str(tmp_path / 'cache')
+    wordsquare.WordSquare(str(words), cache).index(3)
+    path = tmp_path / 'cache' / 'words.txt.3.idx'
+
+    words.write_text('cat\ndog\nact\n')
+    assert wordsquare.WordSquare(str(words), cache).index(3).words == ['CAT', 'DOG', 'ACT']
+    assert list(wordsquare.WordSquare(str(words), cache).index(3).words) == ['CAT', 'DOG', 'ACT']
+
+    path.write_bytes(path.read_bytes()[:-1])
+    assert wordsquare.WordIndex.load(str(path), wordsquare.WordSquare(str(words)).digest,
+                                     wordsquare.WordSquare.alphabet) is None
+    assert wordsquare.WordSquare(str(words), cache).index(3).words == ['CAT', 'DOG', 'ACT']
+    assert list(wordsquare.WordSquare(str(words), cache).index(3).words) == ['CAT', 'DOG', 'ACT']
+
+
+def test_word_index_stays_in_memory_without_a_writable_cache(tmp_path):
+    wordsquare = example('wordsquare')
+    words = tmp_path / 'words.txt'
+    words.write_text('cat\ndog\n')
+    # A directory can't be made under a regular file.
+    square = wordsquare.WordSquare(str(words), str(words / 'cache'))
+    assert square.index(3).words == ['CAT', 'DOG']
+    assert square.csp(3).solve() is None
+    assert list(tmp_path.iterdir()) == [words]
+
 if __name__ == '__main__':
     unittest.main()